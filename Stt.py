@@ -1,16 +1,29 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from openpyxl import load_workbook
-from langdetect import detect_langs, DetectorFactory, detect
+from langdetect import DetectorFactory
+from langdetect.detector_factory import PROFILES_DIRECTORY
+from langdetect.lang_detect_exception import LangDetectException
 import ahocorasick
 import requests
 import deepl
 import os
+import json
+import pickle
+import re
 import shutil
+import threading
+import unicodedata
+from collections import OrderedDict
 from enum import Enum
-from typing import Dict, Tuple, List, Union
+from typing import Dict, Tuple, List, NamedTuple, Optional, Union
 import time # for speed logging
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException
 from Key import OpenAI_API_KEY, DEEPL_API_KEY
+from stt_backends import stt_backend, openai_backend, TranscriptResult
+from translation_cache import translation_cache
+from zh_convert import zh_converter
+from http_pool import get_http_session, run_blocking, HTTP_TIMEOUT
 
 DetectorFactory.seed = 0
 class LANGUAGES(Enum):
@@ -19,21 +32,35 @@ class LANGUAGES(Enum):
     JAPANESE = "ja"
     GERMAN = "de"
 
-# uses openai Whisper API
+# speech-to-text, the engine itself is a stt_backends.stt_backend (openai Whisper API by default)
 class STT(object):
 
-    def __init__(self, client:OpenAI, keywords:List[str]=None):
+    # async_client: optional AsyncOpenAI client used by atranscript
+    # backend: stt_backend to use instead of the openai Whisper API
+    def __init__(self, client:OpenAI=None, keywords:List[str]=None, async_client:AsyncOpenAI=None, backend:stt_backend=None):
         self.client = client
+        self.async_client = async_client
+        self.backend = backend if backend is not None else openai_backend(client, async_client)
         self.init_prompt = self._make_init_prompt(keywords)
 
+    # audio_file: file object, or in-memory 16kHz mono PCM (bytes / memoryview)
     def transcript(self, audio_file) -> str:
-        result = self.client.audio.transcriptions.create(
-            model="whisper-1", 
-            file=audio_file,
-            prompt=self.init_prompt
-        )
-        # print(result)
-        return result.text
+        return self.transcript_result(audio_file).text
+
+    # text plus whisper's detected language, timestamps and duration
+    def transcript_result(self, audio_file) -> TranscriptResult:
+        return self.backend.transcribe(audio_file, self.init_prompt)
+
+    # async version of transcript, never blocks the event loop
+    async def atranscript(self, audio_file) -> str:
+        return (await self.atranscript_result(audio_file)).text
+
+    async def atranscript_result(self, audio_file) -> TranscriptResult:
+        return await self.backend.atranscribe(audio_file, self.init_prompt)
+
+    # transcribes several segments at once, local backends decode them in one batch
+    def transcript_batch(self, audio_files:List) -> List[TranscriptResult]:
+        return self.backend.transcribe_batch(audio_files, self.init_prompt)
 
     def transcript_by_path(self, audio_file_path:str) -> str:
         audio_file = open(audio_file_path, "rb")
@@ -45,6 +72,7 @@ class STT(object):
         return prompt
     
     def _make_init_prompt(self, keywords: list[str]) -> str:
+        prompt = None
         if keywords:
             prompt = "Recognize the following keywords accurately and emphasize them strongly: " + ", ".join(keywords) + ". "
             
@@ -62,32 +90,99 @@ class STT(object):
     
     def transcript_by_chunk(self, audio_chunk: bytes) -> str:
         try:
-            with open("complete_audio.wav", "rb") as f:
-                result = self.client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=f,
-                    prompt=self.init_prompt
-                )
-            return result.text
+            return self.transcript(audio_chunk)
         except Exception as e:
             print(f"Transcription error: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Error transcribing audio: {str(e)}")
 
 # detecting transcribed text's language
+# langdetect only scores the profiles of LANGUAGES (zh-cn / zh-tw both mean tw),
+# kana / han text is decided by its script without running langdetect at all
 class lang_detector(object):
-    
-    def __init__(self):
-        pass
-
-    def detect_language_text(self, text:str) -> str:
-        detected = detect_langs(text)
-        # for lang in detected:
-        #     print(lang)
-        filtered = [lang for lang in detected if lang.lang in [x.value for x in LANGUAGES]]
-        if filtered:
-            result = max(filtered, key=lambda l: l.prob).lang
+    _PROFILES = {"en": "en", "de": "de", "ja": "ja", "zh-cn": "tw", "zh-tw": "tw"} # langdetect profile -> LANGUAGES
+    _KANA = re.compile(r"[\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]")
+    _HAN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+    _LATIN_WORD = re.compile(r"[A-Za-z\u00c0-\u024f]+")
+    _factory = None # restricted profiles are loaded once per process
+    _factory_lock = threading.Lock()
+
+    # cache_size: how many recent texts keep their result
+    # switch_probability, switch_letters: smoothing only switches away from the previous language
+    #   when langdetect is at least this sure and the text has at least this many letters
+    #   (langdetect is overconfident on short texts like "OK" or "Ja")
+    def __init__(self, cache_size:int=4096, switch_probability:float=0.9, switch_letters:int=12):
+        self._cache: "OrderedDict[str, List[Tuple[str, float]]]" = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self._switch_probability = switch_probability
+        self._switch_letters = switch_letters
+
+    @classmethod
+    def _get_factory(cls) -> DetectorFactory:
+        if cls._factory is None:
+            with cls._factory_lock:
+                if cls._factory is None:
+                    factory = DetectorFactory()
+                    factory.seed = 0
+                    profiles = []
+                    for profile in cls._PROFILES:
+                        with open(os.path.join(PROFILES_DIRECTORY, profile), "r", encoding="utf-8") as file:
+                            profiles.append(file.read())
+                    factory.load_json_profile(profiles)
+                    cls._factory = factory
+        return cls._factory
+
+    def _script_language(self, text:str) -> str:
+        if self._KANA.search(text):
+            return LANGUAGES.JAPANESE.value
+        han = len(self._HAN.findall(text))
+        # chinese sentences often contain a few english keywords
+        if han and han >= len(self._LATIN_WORD.findall(text)):
+            return LANGUAGES.TAIWANESE.value
+        return None
+
+    # returns [(language, probability)] sorted by probability, empty if nothing could be detected
+    def detect_language_probs(self, text:str) -> List[Tuple[str, float]]:
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        with self._cache_lock:
+            if normalized in self._cache:
+                self._cache.move_to_end(normalized)
+                return self._cache[normalized]
+        script_language = self._script_language(normalized)
+        if script_language is not None:
+            probs = [(script_language, 1.0)]
         else:
-            result = LANGUAGES.ENGLISH.value
+            detector = self._get_factory().create()
+            detector.append(normalized)
+            merged = dict()
+            try:
+                for lang in detector.get_probabilities():
+                    language = self._PROFILES[lang.lang]
+                    merged[language] = merged.get(language, 0.0) + lang.prob
+            except LangDetectException:
+                pass # no letters in the text
+            probs = sorted(merged.items(), key=lambda item: item[1], reverse=True)
+        with self._cache_lock:
+            self._cache[normalized] = probs
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return probs
+
+    def detect_language_text(self, text:str, previous_language:str=None) -> Optional[str]:
+        """previous_language: language of the previous segment of the same speaker / meeting,
+            kept unless the text is clearly in another language
+        returns None when there is no previous language and the text is too short or unclear to tell,
+        the caller picks its own default then
+        """
+        probs = self.detect_language_probs(text)
+        if not probs:
+            return previous_language
+        result, probability = probs[0]
+        if result == previous_language or self._script_language(text) is not None:
+            return result
+        letters = sum(len(word) for word in self._LATIN_WORD.findall(text))
+        if probability < self._switch_probability or letters < self._switch_letters:
+            return previous_language
         return result
 
 
@@ -184,34 +279,153 @@ def get_keywords_dictionary(excel_file_path:str = "Knowledge Dataset.xlsx") -> T
     return keyword_dict, num_dict
 
 
+# loads the knowledge dataset once per process instead of once per caller / connection
+# the parsed dictionaries are cached in a JSON file next to the excel file, keyed on its mtime,
+# so restarts skip openpyxl too. reload_if_changed() picks up edits to the spreadsheet.
+# the keyword automaton is built here too (and pickled next to the excel file), every user shares it
+class keyword_store(object):
+
+    def __init__(self, excel_file_path:str = "Knowledge Dataset.xlsx", cache_path:str = None, finder_cache_path:str = None):
+        self._excel_file_path = excel_file_path
+        self._cache_path = cache_path or excel_file_path + ".cache.json"
+        self._finder_cache_path = finder_cache_path or excel_file_path + ".automaton.pkl"
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.version = 0 # increases on every reload, users rebuild their derived data when it changes
+        self.reload()
+
+    @property
+    def keyword_dict(self) -> Dict[str, Dict[str, Tuple[int:str]]]:
+        return self._keyword_dict
+
+    @property
+    def num_dict(self) -> Dict[str, Dict[int, Tuple[str:str]]]:
+        return self._num_dict
+
+    @property
+    def finder(self) -> "pattern_finder":
+        return self._finder
+
+    # used for whisper prompt
+    def keywords(self) -> set:
+        return get_keywords_from_dict(self._keyword_dict)
+
+    def reload_if_changed(self) -> bool:
+        if os.path.getmtime(self._excel_file_path) == self._mtime:
+            return False
+        self.reload()
+        return True
+
+    def reload(self):
+        with self._lock:
+            mtime = os.path.getmtime(self._excel_file_path)
+            dictionaries = self._load_cache(mtime)
+            if dictionaries is None:
+                dictionaries = get_keywords_dictionary(self._excel_file_path)
+                self._save_cache(mtime, *dictionaries)
+            self._keyword_dict, self._num_dict = dictionaries
+            self._finder = self._load_finder(mtime)
+            if self._finder is None:
+                self._finder = pattern_finder(self._keyword_dict)
+                self._save_finder(mtime, self._finder)
+            self._mtime = mtime
+            self.version += 1
+
+    def _load_cache(self, mtime:float):
+        try:
+            with open(self._cache_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if data.get("mtime") != mtime:
+            return None
+        # json turns tuples into lists and int keys into strings, restore them
+        keyword_dict = {language: {keyword: tuple(value) for keyword, value in inner.items()}
+                        for language, inner in data["keyword_dict"].items()}
+        num_dict = {language: {int(keyword_num): tuple(value) for keyword_num, value in inner.items()}
+                    for language, inner in data["num_dict"].items()}
+        return keyword_dict, num_dict
+
+    def _save_cache(self, mtime:float, keyword_dict, num_dict):
+        try:
+            with open(self._cache_path, "w", encoding="utf-8") as file:
+                json.dump({"mtime": mtime, "keyword_dict": keyword_dict, "num_dict": num_dict}, file, ensure_ascii=False)
+        except OSError as e:
+            print(f"Could not write keyword cache: {e}")
+
+    def _load_finder(self, mtime:float) -> "pattern_finder":
+        try:
+            with open(self._finder_cache_path, "rb") as file:
+                data = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("mtime") != mtime or data.get("version") != pattern_finder.CACHE_VERSION:
+            return None
+        return data["finder"]
+
+    def _save_finder(self, mtime:float, finder:"pattern_finder"):
+        try:
+            with open(self._finder_cache_path, "wb") as file:
+                pickle.dump({"mtime": mtime, "version": pattern_finder.CACHE_VERSION, "finder": finder}, file)
+        except OSError as e:
+            print(f"Could not write keyword automaton cache: {e}")
+
+_keyword_stores = dict()
+_keyword_stores_lock = threading.Lock()
+
+# shared keyword_store per excel file
+def get_keyword_store(excel_file_path:str = "Knowledge Dataset.xlsx") -> keyword_store:
+    with _keyword_stores_lock:
+        if excel_file_path not in _keyword_stores:
+            _keyword_stores[excel_file_path] = keyword_store(excel_file_path)
+        return _keyword_stores[excel_file_path]
+
+
+class keyword_match(NamedTuple):
+    id: int # keyword number, shared between languages
+    language: str # language of the keyword that matched
+    start: int # text[start:end] is the keyword
+    end: int
+
+# one Aho-Corasick automaton for the keywords of every language, a text is scanned once
+# for all of them. picklable (pyahocorasick supports it), keyword_store caches it on disk
 class pattern_finder(object):
+    CACHE_VERSION = 1 # bump when the automaton's values change shape
+
     def __init__(self, keyword_dict:Dict[str, Dict[str, Tuple[int:str]]]):
-        self._automaton = dict()
+        # the same spelling can be a keyword in several languages (e.g. English terms in the Chinese sheet)
+        owners = dict() # lowered pattern -> [(keyword number, language)]
         for language in LANGUAGES:
             language = language.value
-            language_automaton = ahocorasick.Automaton()
             for pattern, (idx, explanation) in keyword_dict[language].items():
-                language_automaton.add_word(pattern.lower(), idx)
-            language_automaton.make_automaton()
-            self._automaton[language] = language_automaton
+                owners.setdefault(pattern.lower(), []).append((idx, language))
+        self._automaton = ahocorasick.Automaton()
+        for pattern, pattern_owners in owners.items():
+            self._automaton.add_word(pattern, (len(pattern), tuple(pattern_owners)))
+        self._automaton.make_automaton()
 
-    def __make_keyword_output__(self, key_nums:List[int], num_dict:Dict[str, Dict[int, Tuple[str:str]]], language=LANGUAGES.TAIWANESE.value):
-        output_path = "KEYWORDS_2.txt"
+    def __make_keyword_output__(self, key_nums:List[int], num_dict:Dict[str, Dict[int, Tuple[str:str]]], language=LANGUAGES.TAIWANESE.value, output_path:str="KEYWORDS_2.txt"):
         with open(output_path, "a", encoding="utf-8") as file:
             for key_num in key_nums:
                 keyword = num_dict[language][key_num][0]
                 file.write(keyword + "\n")
     
-    # returns List[int]: list of keyword's number
-    def find_pattern(self, text:str, language:str) -> List[int]:
+    # every keyword occurrence in text, in order of where it ends
+    # language: only keywords of this language (or these languages), None for all of them
+    # positions index the lowered text, which has the same length for the scripts we support
+    def find_matches(self, text:str, language:Union[str, List[str]]=None) -> List[keyword_match]:
+        if isinstance(language, str):
+            language = (language,)
         matches = []
-        for end_pos, pattern_id in self._automaton[language].iter(text.lower()):
-            matches.append(pattern_id)
-            # comment: below for finding position
-            # match = patterns[pattern_id]
-            # matches.append((match, end_pos - len(match) + 1, end_pos))
+        for end_pos, (length, pattern_owners) in self._automaton.iter(text.lower()):
+            for idx, pattern_language in pattern_owners:
+                if language is None or pattern_language in language:
+                    matches.append(keyword_match(idx, pattern_language, end_pos - length + 1, end_pos + 1))
         return matches # TSMC requirement: don't remove duplicates
-        return self._remove_duplicates_sorted(matches)
+
+    # returns List[int]: list of keyword's number
+    def find_pattern(self, text:str, language:str) -> List[int]:
+        return [match.id for match in self.find_matches(text, language)]
     
     def _remove_duplicates_sorted(self, lst) -> List[int]:
         seen = set()
@@ -245,8 +459,14 @@ class explainer(object):
 class text_translator(object):
     _translate_deepl_source_language_code = {LANGUAGES.ENGLISH.value:"EN", LANGUAGES.TAIWANESE.value:"ZH", LANGUAGES.JAPANESE.value:"JA", LANGUAGES.GERMAN.value:"DE"}
     _target_deepl_language_code = {LANGUAGES.ENGLISH.value:"EN-US", LANGUAGES.TAIWANESE.value:"ZH", LANGUAGES.JAPANESE.value:"JA", LANGUAGES.GERMAN.value:"DE"}
-    def __init__(self, deepl_client):
+    # DeepL limits: at most 50 texts and 128 KiB request body per request
+    _deepl_max_texts = 50
+    _deepl_max_bytes = 120 * 1024
+    # converter: Simplified -> Traditional Chinese converter, protecting the glossary keywords
+    def __init__(self, deepl_client, cache:translation_cache=None, converter:zh_converter=None):
         self._deepl_client = deepl_client
+        self._cache = cache
+        self._zh_converter = converter if converter is not None else zh_converter()
         self._init_glossary_name_id_dict()
     
     def _init_glossary_name_id_dict(self):
@@ -255,20 +475,51 @@ class text_translator(object):
             glossary_name_id_dict[glossary_info.name] = glossary_info.glossary_id
         self._glossary_name_id_dict = glossary_name_id_dict
 
+    def set_converter(self, converter:zh_converter):
+        self._zh_converter = converter
+
     def translate_text(self, text:str, source_language:str, target_language:str) -> str:
         if source_language == target_language:
+            # whisper may still write chinese in simplified characters, same as translate_batch
+            if target_language == LANGUAGES.TAIWANESE.value:
+                return self._zh_converter.convert(text)
             return text
+        key = None
+        if self._cache is not None:
+            key = self._cache_key(text, source_language, target_language)
+            hit, cached = self._cache.get(key)
+            if hit:
+                # None: every backend failed on this text moments ago, don't ask them again yet
+                return text if cached is None else cached
+        try:
+            result = self._translate_text(text, source_language, target_language)
+        except:
+            if key is not None:
+                self._cache.put_failure(key)
+            raise
+        if result == "":
+            if key is not None:
+                self._cache.put_failure(key)
+            result = text
+        elif key is not None:
+            self._cache.put(key, result)
+        return result
+
+    def _translate_text(self, text:str, source_language:str, target_language:str) -> str:
         try:
             result = self.translate_deepl(text, source_language, target_language)
             if target_language == LANGUAGES.TAIWANESE.value:
-                result = self.translate_google(result, 'zh-CN', target_language)
+                # DeepL outputs Simplified Chinese, convert locally instead of another request
+                result = self._zh_converter.convert(result)
         except:
             # print("Deepl error, moving to google")
             result = self.translate_google(text, source_language, target_language)
-        if result == "":
-            result = text
         return result
 
+    def _cache_key(self, text:str, source_language:str, target_language:str):
+        glossary_id = self._glossary_name_id_dict.get("_".join([source_language, target_language]))
+        return translation_cache.make_key(text, source_language, target_language, glossary_id)
+
     def translate_deepl(self, text:str, source_language:str, target_language:str) -> str:
         # normally at this point source and target won't be the same, but just in case
         if source_language == target_language:
@@ -282,6 +533,112 @@ class text_translator(object):
             glossary = glossary_id  # Use glossary
         )
         return result.text
+
+    # async versions, the SDK calls run in worker threads so the event loop is never blocked
+    async def atranslate_text(self, text:str, source_language:str, target_language:str) -> str:
+        return await run_blocking(self.translate_text, text, source_language, target_language)
+
+    async def atranslate_deepl(self, text:str, source_language:str, target_language:str) -> str:
+        return await run_blocking(self.translate_deepl, text, source_language, target_language)
+
+    async def atranslate_google(self, text:str, sl:str = "auto", tl:str = "zh-TW") -> str:
+        return await run_blocking(self.translate_google, text, sl, tl)
+
+    def translate_deepl_batch(self, texts:List[str], source_language:str, target_language:str) -> List[str]:
+        # one request for every text, all texts share the same glossary
+        glossary_name = "_".join([source_language, target_language])
+        glossary_id = self._glossary_name_id_dict[glossary_name]
+        results = self._deepl_client.translate_text(
+            texts,
+            source_lang = text_translator._translate_deepl_source_language_code[source_language],
+            target_lang = text_translator._target_deepl_language_code[target_language],
+            glossary = glossary_id
+        )
+        return [result.text for result in results]
+
+    def translate_batch(self, texts:List[str], source_language:str, target_language:str) -> List[str]:
+        """Translates many texts of one language pair with as few DeepL requests as possible
+            On failure: same fallbacks as translate_text, per text
+        """
+        results = list(texts)
+        if source_language == target_language:
+            # whisper may still write chinese in simplified characters
+            if target_language == LANGUAGES.TAIWANESE.value:
+                return [self._zh_converter.convert(text) for text in results]
+            return results
+        # DeepL rejects empty texts, leave them as they are
+        indices = [i for i, text in enumerate(texts) if text.strip()]
+        keys = dict()
+        if self._cache is not None:
+            missed = []
+            for i in indices:
+                keys[i] = self._cache_key(texts[i], source_language, target_language)
+                hit, cached = self._cache.get(keys[i])
+                if not hit:
+                    missed.append(i)
+                elif cached is not None:
+                    results[i] = cached
+            indices = missed
+        for chunk in self._chunk_indices(indices, texts):
+            chunk_texts = [texts[i] for i in chunk]
+            try:
+                translated = self.translate_deepl_batch(chunk_texts, source_language, target_language)
+                if target_language == LANGUAGES.TAIWANESE.value:
+                    translated = [self._zh_converter.convert(text) for text in translated]
+            except:
+                translated = [self.translate_google(text, source_language, target_language) for text in chunk_texts]
+            for i, result in zip(chunk, translated):
+                if result != "":
+                    results[i] = result
+                if i in keys:
+                    if result != "":
+                        self._cache.put(keys[i], result)
+                    else:
+                        self._cache.put_failure(keys[i])
+        return results
+
+    def translate_segments(self, segments:Dict[int, Tuple[str, str]], target_languages:List[str], executor=None) -> Dict[int, Dict[str, str]]:
+        """segments[segment_id] -> (text, source_language)
+            returns results[segment_id][target_language] -> translated text
+            Segments are grouped by (source, target), which also decides the glossary,
+            so the request count is about the number of language pairs, not segments x languages
+        """
+        groups = dict()
+        for segment_id, (text, source_language) in segments.items():
+            for target_language in target_languages:
+                groups.setdefault((source_language, target_language), []).append(segment_id)
+        batches = dict()
+        for (source_language, target_language), segment_ids in groups.items():
+            texts = [segments[segment_id][0] for segment_id in segment_ids]
+            if executor is None:
+                batches[(source_language, target_language)] = self.translate_batch(texts, source_language, target_language)
+            else:
+                batches[(source_language, target_language)] = executor.submit(self.translate_batch, texts, source_language, target_language)
+        results = {segment_id: dict() for segment_id in segments}
+        for (source_language, target_language), segment_ids in groups.items():
+            batch = batches[(source_language, target_language)]
+            translated = batch if executor is None else batch.result()
+            for segment_id, text in zip(segment_ids, translated):
+                results[segment_id][target_language] = text
+        return results
+
+    @staticmethod
+    def _chunk_indices(indices:List[int], texts:List[str]) -> List[List[int]]:
+        # keep every request under DeepL's text count and request size limits
+        chunks = []
+        chunk = []
+        chunk_bytes = 0
+        for i in indices:
+            text_bytes = len(texts[i].encode("utf-8"))
+            if chunk and (len(chunk) >= text_translator._deepl_max_texts or chunk_bytes + text_bytes > text_translator._deepl_max_bytes):
+                chunks.append(chunk)
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(i)
+            chunk_bytes += text_bytes
+        if chunk:
+            chunks.append(chunk)
+        return chunks
     
     def translate_google(self, text:str, sl:str = "auto", tl:str = "zh-TW"):
         """On failure: return empty string
@@ -302,7 +659,12 @@ class text_translator(object):
             "dt": "t",     # data type (translated text)
             "q": text     # the text to translate
         }
-        response = requests.get(url, params=params)
+        # pooled keep-alive session instead of a new connection per call
+        try:
+            response = get_http_session().get(url, params=params, timeout=HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Google translate error: {e}")
+            return ""
         if response.status_code == 200:
             result = response.json()[0]
             sentences = []
@@ -342,27 +704,56 @@ class text_translator(object):
                 
 class meeting_translator(object):
 
-    def __init__(self, openai_client, deepl_client):
-        self._keyword_dict, self._num_dict = get_keywords_dictionary()
-        self._STT_model = STT(openai_client, keywords=get_keywords_from_dict(self._keyword_dict))
+    # max_workers: how many translation requests may be in flight at once
+    # cache: shared translation cache, an in-memory one is created if not given
+    # keywords: shared keyword_store, the default store is used if not given
+    # stt_backend: speech-to-text engine, the openai Whisper API if not given
+    def __init__(self, openai_client, deepl_client, max_workers:int=8, cache:translation_cache=None, keywords:keyword_store=None, stt_backend:stt_backend=None):
+        self._openai_client = openai_client
+        self._stt_backend = stt_backend
+        self._keywords = keywords if keywords is not None else get_keyword_store()
         self._language_detector = lang_detector()
-        self._keyword_finder = pattern_finder(self._keyword_dict)
-        self._text_language_changer = text_translator(deepl_client)
-        self._keyword_explainer = explainer(self._num_dict)
+        self._translation_cache = cache if cache is not None else translation_cache()
+        self._text_language_changer = text_translator(deepl_client, cache=self._translation_cache)
         self._transcribed_text = ""
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._keywords_version = None
+        self.refresh_keywords()
+
+    # rebuilds everything derived from the keywords if the knowledge dataset changed
+    def refresh_keywords(self, check_file:bool=True):
+        if check_file:
+            self._keywords.reload_if_changed()
+        if self._keywords_version == self._keywords.version:
+            return
+        self._keyword_dict, self._num_dict = self._keywords.keyword_dict, self._keywords.num_dict
+        self._STT_model = STT(self._openai_client, keywords=self._keywords.keywords(), backend=self._stt_backend)
+        self._keyword_finder = self._keywords.finder
+        self._keyword_explainer = explainer(self._num_dict)
+        self._text_language_changer.set_converter(zh_converter(self._keyword_dict[LANGUAGES.TAIWANESE.value]))
+        self._keywords_version = self._keywords.version
 
     def translate_by_audio_path(self, audio_file_path:str, target_languages:Union[str,List[str]]) -> Union[str,List[str]]:
         audio_file = open(audio_file_path, "rb")
         return self.translate_by_audio(audio_file, target_languages)
-    
+
+    # whisper decides the language from the audio itself, which is more reliable than the text,
+    # langdetect (with smoothing) is only used when whisper reported a language outside LANGUAGES
+    def source_language(self, result:TranscriptResult, previous_language:str=None) -> str:
+        if result.language is not None:
+            return result.language
+        return self._language_detector.detect_language_text(result.text, previous_language) or LANGUAGES.ENGLISH.value
+
     def translate_by_audio(self, audio_file, target_languages:str|List[str]=LANGUAGES.TAIWANESE.value) -> str|List[str]:
-        self._transcribed_text = self._STT_model.transcript(audio_file)
-        source_language = self._language_detector.detect_language_text(self._transcribed_text)
+        result = self._STT_model.transcript_result(audio_file)
+        self._transcribed_text = result.text
+        source_language = self.source_language(result)
         if isinstance(target_languages, str):
             return self.translate_by_text(self._transcribed_text, source_language, target_languages)
         else:
             return self.translate_by_text_multi_language(self._transcribed_text, source_language, target_languages)
     
+    # keyword_nums: keywords the caller already found in text, matched here only when not given
     def translate_by_text(self, text:str, source_language:str, target_language:str, keyword_nums:List[int]=None) -> str:
         # no need to check source-target language, since this also adds explained text
         if keyword_nums == None:
@@ -374,20 +765,30 @@ class meeting_translator(object):
         # explained_text = self._keyword_explainer.explain_text(translated_text, target_language, keyword_nums)
         # return explained_text
     
+    async def atranslate_by_text(self, text:str, source_language:str, target_language:str, keyword_nums:List[int]=None) -> str:
+        return await run_blocking(self.translate_by_text, text, source_language, target_language, keyword_nums)
+
     # BETA function, deepl may fail
     def translate_by_text_multi_language(self, text:str, source_language:str, target_languages:List[str], keyword_nums:List[int]=None) -> List[str]:
         if keyword_nums == None:
             keyword_nums = self._keyword_finder.find_pattern(text, source_language)
-        results = []
-        for target_language in target_languages:
-            results.append(self.translate_by_text(text, source_language, target_language, keyword_nums))
-        return results
+        futures = [self._executor.submit(self.translate_by_text, text, source_language, target_language, keyword_nums)
+                   for target_language in target_languages]
+        return [future.result() for future in futures]
+
+    # translates every text into every target language
+    # returns Dict[target_language, List[str]], in the same order as texts
+    # uses one batched DeepL request per (source, target) pair, the pairs run concurrently
+    def translate_texts_multi_language(self, texts:List[str], source_languages:List[str], target_languages:List[str]) -> Dict[str, List[str]]:
+        segments = {i: (text, source_language) for i, (text, source_language) in enumerate(zip(texts, source_languages))}
+        results = self._text_language_changer.translate_segments(segments, target_languages, executor=self._executor)
+        return {target_language: [results[i][target_language] for i in range(len(texts))]
+                for target_language in target_languages}
     
     def _get_last_transcribed(self) -> str:
         return self._transcribed_text
     
-    def __make_keyword_output__(self, key_nums:List[int], num_dict:Dict[str, Dict[int, Tuple[str:str]]], language='tw'):
-        output_path = "KEYWORDS_2.txt"
+    def __make_keyword_output__(self, key_nums:List[int], num_dict:Dict[str, Dict[int, Tuple[str:str]]], language='tw', output_path:str="KEYWORDS_2.txt"):
         with open(output_path, "a", encoding="utf-8") as file:
             for key_num in key_nums:
                 keyword = num_dict[language][key_num][0]
@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+import deepl
+from openai import OpenAI
+from Key import OpenAI_API_KEY, DEEPL_API_KEY
+from Stt import meeting_translator, LANGUAGES
+from function import merge_audio_files, AUDIO_EXTENSIONS
+from process_audio import iter_audio_segments
+from translation_cache import translation_cache
+from http_pool import configure_deepl, OPENAI_TIMEOUT
+from stt_backends import openai_backend, local_whisper_backend
+from messages import keyword_positions
+from meeting_store import meeting_store
+
+# 批次轉錄/翻譯封存的會議錄音
+# python batch_transcribe.py recordings/ --output-dir batch_output --workers 4
+# 每場會議輸出一個 <meeting_id>.json，中斷後重新執行會從已完成的片段繼續
+
+SAMPLE_RATE = 16000
+TARGET_LANGUAGES = [language.value for language in LANGUAGES]
+
+# 每個 worker（process 或整個 thread pool）共用一個 meeting_translator 與 meeting_store
+_translator: Optional[meeting_translator] = None
+_store: Optional[meeting_store] = None
+
+def _init_worker(cache_db:str, backend_name:str="openai", local_model:str="small", meeting_db:str="meetings.db"):
+    global _translator, _store
+    configure_deepl()
+    openai_client = OpenAI(api_key=OpenAI_API_KEY, timeout=OPENAI_TIMEOUT)
+    deepl_client = deepl.Translator(DEEPL_API_KEY)
+    if backend_name == "local":
+        stt_backend = local_whisper_backend(model_size=local_model)
+    else:
+        stt_backend = openai_backend(openai_client)
+    _translator = meeting_translator(openai_client, deepl_client, cache=translation_cache(db_path=cache_db), stt_backend=stt_backend)
+    _store = meeting_store(db_path=meeting_db)
+
+def collect_recordings(inputs:List[str], manifest_path:str=None) -> List[Tuple[str, str]]:
+    """
+    從資料夾/檔案/manifest 找出所有錄音檔
+    manifest 每行一個路徑，可以用 tab 接上自訂的 meeting_id，# 開頭為註解
+    Returns:
+        [(meeting_id, path)]
+    """
+    entries = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.rsplit(".", 1)[-1].lower() in AUDIO_EXTENSIONS:
+                        entries.append((None, os.path.join(root, name)))
+        else:
+            entries.append((None, path))
+    if manifest_path is not None:
+        with open(manifest_path, "r", encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                path, _, meeting_id = line.partition("\t")
+                entries.append((meeting_id.strip() or None, path.strip()))
+
+    recordings = []
+    used_ids = set()
+    for meeting_id, path in entries:
+        meeting_id = meeting_id or os.path.splitext(os.path.basename(path))[0]
+        # 不同資料夾中同名的錄音不能寫到同一個輸出檔
+        unique_id, suffix = meeting_id, 2
+        while unique_id in used_ids:
+            unique_id = f"{meeting_id}_{suffix}"
+            suffix += 1
+        used_ids.add(unique_id)
+        recordings.append((unique_id, path))
+    return recordings
+
+def _load_checkpoint(checkpoint_path:str) -> Dict[int, dict]:
+    """
+    讀取已經轉錄完成的片段（同一個片段出現多次時以最後一筆為準）
+    """
+    records = dict()
+    if not os.path.exists(checkpoint_path):
+        return records
+    with open(checkpoint_path, "r", encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 中斷時可能只寫了半行
+                continue
+            records[record["segment_id"]] = record
+    return records
+
+def transcribe_meeting(meeting_id:str, audio_path:str, output_dir:str, target_languages:List[str], segment_workers:int=4) -> dict:
+    """
+    一場會議：斷句 -> STT -> 翻譯 -> 關鍵字，結果寫到 <output_dir>/<meeting_id>.json
+    每個片段轉錄完就寫進 checkpoint，重新執行時跳過已完成的片段
+    """
+    output_path = os.path.join(output_dir, meeting_id + ".json")
+    if os.path.exists(output_path):
+        # 已經處理過；還沒寫進 meeting_store 時（例如寫入前中斷）從輸出檔補上
+        if not _store.has_meeting(meeting_id):
+            with open(output_path, "r", encoding="utf-8") as file:
+                result = json.load(file)
+            _store.save_meeting(meeting_id, result["source_path"], result["duration"], result["segments"])
+        return {"meeting_id": meeting_id, "status": "skipped"}
+    time_start = time.time()
+    checkpoint_path = os.path.join(output_dir, meeting_id + ".partial.jsonl")
+    done = _load_checkpoint(checkpoint_path)
+
+    translator = _translator
+    translator.refresh_keywords()
+    stt_model = translator._STT_model
+    language_detector = translator._language_detector
+
+    pcm = merge_audio_files(audio_path)
+    checkpoint_lock = threading.Lock()
+
+    def transcribe(batch):
+        # batch: [(segment_id, segment)]，本機引擎一次解碼整批，API 則逐段送出
+        results = stt_model.transcript_batch([segment.pcm for _, segment in batch])
+        records = []
+        for (segment_id, segment), result in zip(batch, results):
+            records.append({
+                "segment_id": segment_id,
+                "start": segment.start,
+                "end": segment.end,
+                "original_text": result.text,
+                # Whisper 偵測的語言（不在 LANGUAGES 內為 None）與片段內的時間戳（秒，相對於片段開頭）
+                "language": result.language,
+                "timestamps": [[part.start, part.end, part.text] for part in result.segments]
+            })
+        with checkpoint_lock:
+            with open(checkpoint_path, "a", encoding="utf-8") as file:
+                for record in records:
+                    file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return records
+
+    # 斷句是固定的，同一個錄音每次切出來的片段都一樣；位置對不上時（錄音換過）重新轉錄
+    records = dict()
+    batch_size = stt_model.backend.batch_size
+    with ThreadPoolExecutor(max_workers=segment_workers) as executor:
+        futures = []
+        batch = []
+        for segment_id, segment in enumerate(iter_audio_segments(pcm)):
+            record = done.get(segment_id)
+            if record is not None and (record["start"], record["end"]) == (segment.start, segment.end):
+                records[segment_id] = record
+                continue
+            batch.append((segment_id, segment))
+            if len(batch) >= batch_size:
+                futures.append(executor.submit(transcribe, batch))
+                batch = []
+        if batch:
+            futures.append(executor.submit(transcribe, batch))
+        resumed = len(records)
+        for future in futures:
+            for record in future.result():
+                records[record["segment_id"]] = record
+
+    # 優先使用 Whisper 偵測的語言，沒有時才依片段順序用文字偵測，短句或不確定時沿用前一段的語言
+    ordered = [records[segment_id] for segment_id in sorted(records)]
+    previous_language = None
+    for record in ordered:
+        previous_language = record.get("language") or language_detector.detect_language_text(record["original_text"], previous_language) \
+            or LANGUAGES.ENGLISH.value
+        record["source_language"] = previous_language
+    texts = [record["original_text"] for record in ordered]
+    source_languages = [record["source_language"] for record in ordered]
+    translations = translator.translate_texts_multi_language(texts, source_languages, target_languages)
+
+    segments = []
+    keyword_hits = []
+    for index, record in enumerate(ordered):
+        keyword_matches = translator._keyword_finder.find_matches(record["original_text"], record["source_language"])
+        keywords = [match.id for match in keyword_matches]
+        keyword_hits.extend(keywords)
+        start_time = record["start"] / 2 / SAMPLE_RATE
+        segments.append({
+            "segment_id": record["segment_id"],
+            "start_time": start_time,
+            "end_time": record["end"] / 2 / SAMPLE_RATE,
+            "source_language": record["source_language"],
+            "original_text": record["original_text"],
+            "translations": {language: translations[language][index] for language in target_languages},
+            "keywords": keywords,
+            "keyword_positions": keyword_positions(keyword_matches),
+            # Whisper 的時間戳換算成整場會議的時間
+            "timestamps": [
+                {"start": start_time + start, "end": start_time + end, "text": text}
+                for start, end, text in record.get("timestamps", [])
+            ]
+        })
+
+    result = {
+        "meeting_id": meeting_id,
+        "source_path": audio_path,
+        "duration": len(pcm) / 2 / SAMPLE_RATE,
+        "segments": segments,
+        "keywords": sorted(set(keyword_hits))
+    }
+    # 先寫暫存檔再改名，輸出檔存在就代表這場會議已經完整處理過
+    temp_path = output_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(result, file, ensure_ascii=False, indent=4)
+    os.replace(temp_path, output_path)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    _store.save_meeting(meeting_id, audio_path, result["duration"], segments)
+
+    return {
+        "meeting_id": meeting_id,
+        "status": "complete",
+        "segments": len(segments),
+        "resumed": resumed,
+        "runtime": time.time() - time_start
+    }
+
+def main(argv:List[str]=None) -> int:
+    parser = argparse.ArgumentParser(description="批次轉錄並翻譯會議錄音")
+    parser.add_argument("inputs", nargs="*", help="錄音檔或包含錄音檔的資料夾")
+    parser.add_argument("--manifest", help="錄音清單，每行一個路徑（可用 tab 接 meeting_id）")
+    parser.add_argument("--output-dir", default="batch_output", help="輸出資料夾")
+    parser.add_argument("--languages", default=",".join(TARGET_LANGUAGES), help="翻譯的目標語言，以逗號分隔")
+    parser.add_argument("--workers", type=int, default=2, help="同時處理的會議數")
+    parser.add_argument("--executor", choices=("process", "thread"), default="process", help="會議之間使用 process 或 thread 平行處理")
+    parser.add_argument("--segment-workers", type=int, default=4, help="每場會議同時轉錄的片段數")
+    parser.add_argument("--cache-db", default="translation_cache.db", help="翻譯快取的 SQLite 檔")
+    parser.add_argument("--stt-backend", choices=("openai", "local"), default="openai", help="語音辨識引擎：Whisper API 或本機的 faster-whisper")
+    parser.add_argument("--local-model", default="small", help="本機引擎使用的 Whisper 模型")
+    parser.add_argument("--meeting-db", default="meetings.db", help="記錄所有會議片段、翻譯與關鍵字的 SQLite 檔（可全文搜尋）")
+    args = parser.parse_args(argv)
+
+    recordings = collect_recordings(args.inputs, args.manifest)
+    if not recordings:
+        parser.error("沒有找到任何錄音檔")
+    target_languages = [language.strip() for language in args.languages.split(",") if language.strip()]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.executor == "process":
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(args.cache_db, args.stt_backend, args.local_model, args.meeting_db))
+    else:
+        _init_worker(args.cache_db, args.stt_backend, args.local_model, args.meeting_db)
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+
+    time_start = time.time()
+    failed = []
+    with executor:
+        futures = {
+            executor.submit(transcribe_meeting, meeting_id, path, args.output_dir, target_languages, args.segment_workers): meeting_id
+            for meeting_id, path in recordings
+        }
+        for future in as_completed(futures):
+            meeting_id = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                print(f"[{meeting_id}] Error: {e}")
+                failed.append(meeting_id)
+                continue
+            if summary["status"] == "skipped":
+                print(f"[{meeting_id}] already done, skipped")
+            else:
+                print(f"[{meeting_id}] {summary['segments']} segments ({summary['resumed']} resumed), runtime {summary['runtime']:.1f}s")
+
+    runtime = time.time() - time_start
+    print(f"{len(recordings) - len(failed)}/{len(recordings)} meetings done, runtime {runtime//60} minutes, {runtime%60} seconds")
+    if failed:
+        print("Failed: " + ", ".join(failed))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,39 +1,308 @@
+import io
+import math
+import struct
 import subprocess
 import json
 import wave
+from typing import NamedTuple, Optional
+import numpy as np
+from scipy.signal import resample_poly
 import torch
 import torchaudio
 import noisereduce as nr
 import soundfile as sf
-from openpyxl import load_workbook
 from pydub import AudioSegment
 from demucs import pretrained
 from demucs.apply import apply_model
+from demucs.audio import convert_audio
 import os
+import threading
 
 
 # Keywords
 def get_keywords(excel_file_path = "Knowledge Dataset.xlsx"):
-    workbook = load_workbook(excel_file_path)
-    not_keywords_sheet = 'Training wav'
-    keywords = set()
-    for sheet_name in workbook.sheetnames:
-        if sheet_name == not_keywords_sheet:
-            continue
-        sheet = workbook[sheet_name]
-        for row in range(2,32):
-            keywords.add(sheet[f"B{row}"].value)
-    return keywords
+    # 只在第一次呼叫時讀取 excel（見 Stt.keyword_store），之後直接使用記憶體中的結果
+    from Stt import get_keyword_store
+    return get_keyword_store(excel_file_path).keywords()
+
+# 支援的音檔格式
+AUDIO_EXTENSIONS = ("opus", "flac", "webm", "weba", "wav", "ogg", "m4a", "oga", "mid", "mp3", "aiff", "wma", "au")
+
+# 音檔格式判斷：只看檔頭，不需要 ffmpeg
+def sniff_audio_format(data) -> str:
+    header = bytes(data[:12])
+    if header[:4] in (b"RIFF", b"RIFX") and header[8:12] == b"WAVE":
+        return "wav"
+    if header[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if header[:4] == b"OggS":
+        return "ogg"
+    if header[:4] == b"fLaC":
+        return "flac"
+    if header[4:8] == b"ftyp":
+        return "mp4"
+    if header[:3] == b"ID3" or (len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return "mp3"
+    return "unknown"
+
+class WavInfo(NamedTuple):
+    format_tag: int # 1 = PCM, 3 = IEEE float
+    channels: int
+    sample_rate: int
+    sample_width: int # bytes
+    data_offset: int
+    data_length: Optional[int] # None: 串流寫出的 wav，長度未知（到檔尾為止）
+
+def parse_wav_header(data) -> Optional[WavInfo]:
+    """
+    解析 RIFF/WAVE 檔頭，找到 fmt 與 data chunk；不是 wav 或檔頭還不完整時回傳 None
+    """
+    view = memoryview(data)
+    if len(view) < 12 or bytes(view[:4]) != b"RIFF" or bytes(view[8:12]) != b"WAVE":
+        return None
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        chunk_size = struct.unpack_from("<I", view, offset + 4)[0]
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            if body + 16 > len(view):
+                return None
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", view, body)
+            if format_tag == 0xFFFE and chunk_size >= 40 and body + 26 <= len(view):
+                # WAVE_FORMAT_EXTENSIBLE：真正的格式在 SubFormat GUID 的前兩個 bytes
+                format_tag = struct.unpack_from("<H", view, body + 24)[0]
+            fmt = (format_tag, channels, sample_rate, bits // 8)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            # 串流錄音常把長度寫成 0 或 0xFFFFFFFF
+            data_length = None if chunk_size in (0, 0xFFFFFFFF) else chunk_size
+            return WavInfo(*fmt, body, data_length)
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
+
+def _wav_to_float(data, info:WavInfo) -> Optional[np.ndarray]:
+    # 回傳 (samples, channels) 的 float32；不支援的格式回傳 None
+    if info.format_tag == 1 and info.sample_width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif info.format_tag == 1 and info.sample_width == 2:
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768
+    elif info.format_tag == 1 and info.sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)) << 8 >> 8).astype(np.float32) / 8388608
+    elif info.format_tag == 1 and info.sample_width == 4:
+        samples = np.frombuffer(data, dtype="<i4").astype(np.float32) / 2147483648
+    elif info.format_tag == 3 and info.sample_width == 4:
+        samples = np.frombuffer(data, dtype="<f4")
+    elif info.format_tag == 3 and info.sample_width == 8:
+        samples = np.frombuffer(data, dtype="<f8").astype(np.float32)
+    else:
+        return None
+    return samples.reshape(-1, info.channels)
+
+def decode_wav(data, sample_rate=16000):
+    """
+    不經過 ffmpeg 直接解碼 PCM / float 的 wav
+    已經是 16kHz, 16-bit, 單聲道時直接回傳指向原始資料的 memoryview（不複製）；
+    其他情況在 NumPy 中平均聲道、用 resample_poly 重新取樣
+    Returns:
+        bytes / memoryview: PCM 資料，無法處理的格式回傳 None
+    """
+    info = parse_wav_header(data)
+    if info is None or info.channels == 0 or info.sample_width == 0:
+        return None
+    frame_size = info.channels * info.sample_width
+    end = len(data) if info.data_length is None else min(len(data), info.data_offset + info.data_length)
+    end -= (end - info.data_offset) % frame_size
+    body = memoryview(data)[info.data_offset:end]
+    if info.format_tag == 1 and info.sample_width == 2 and info.channels == 1 and info.sample_rate == sample_rate:
+        return body
+    samples = _wav_to_float(body, info)
+    if samples is None:
+        return None
+    mono = samples.mean(axis=1) if info.channels > 1 else samples[:, 0]
+    if info.sample_rate != sample_rate:
+        factor = math.gcd(info.sample_rate, sample_rate)
+        mono = resample_poly(mono, sample_rate // factor, info.sample_rate // factor)
+    return (np.clip(mono, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
 
 # 音檔轉檔
-def merge_audio_files(input_path, output_path):
-    file_extension = input_path.split(".")[-1].lower()
-    if file_extension in ("opus", "flac", "webm", "weba", "wav", "ogg", "m4a", "oga", "mid", "mid", "mp3", "aiff", "wma", "au"):
-        audio = AudioSegment.from_file(input_path)
+def merge_audio_files(input_data, output_path=None):
+    """
+    把任意格式的音檔轉成 16kHz, 16-bit, 單聲道 PCM
+    wav 在 NumPy 中處理（已經符合格式時不複製），只有壓縮格式才經過 pydub / ffmpeg
+    Args:
+        input_data: 音檔內容 (bytes) 或音檔路徑
+        output_path: 若有指定，另外存成 wav 檔
+    Returns:
+        bytes / memoryview: PCM 資料
+    """
+    if isinstance(input_data, str):
+        file_extension = input_data.split(".")[-1].lower()
+        if file_extension not in AUDIO_EXTENSIONS:
+            raise ValueError(f"Unsupported audio format: {file_extension}")
+        if file_extension == "wav":
+            with open(input_data, "rb") as f:
+                input_data = f.read()
+    pcm = None
+    if not isinstance(input_data, str) and sniff_audio_format(input_data) == "wav":
+        pcm = decode_wav(input_data)
+    if pcm is None:
+        source = input_data if isinstance(input_data, str) else io.BytesIO(input_data)
+        audio = AudioSegment.from_file(source)
         audio = audio.set_channels(1)
         audio = audio.set_frame_rate(16000)
         audio = audio.set_sample_width(2)
-        audio.export(output_path, format="wav")
+        pcm = audio.raw_data
+    if output_path is not None:
+        with wave.open(output_path, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(16000)
+            f.writeframes(pcm)
+    return pcm
+
+def to_wav_buffer(pcm_bytes, name="segment.wav") -> io.BytesIO:
+    """
+    把 PCM 包成記憶體中的 wav 檔，只在呼叫外部 API 時使用
+    """
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(pcm_bytes)
+    buffer.seek(0)
+    buffer.name = name # OpenAI API 以檔名判斷格式
+    return buffer
+
+class StreamDecoder:
+    """
+    常駐的 ffmpeg 行程：持續把串流進來的音檔（webm / ogg / wav ...）解碼成
+    16kHz, 16-bit, 單聲道 PCM，不需要每次都把整段音檔重新轉檔
+    """
+    def __init__(self):
+        self._process = subprocess.Popen(
+            [
+                'ffmpeg',
+                '-loglevel', 'quiet',
+                '-fflags', 'nobuffer',
+                '-i', 'pipe:0',
+                '-f', 's16le',
+                '-ac', '1',
+                '-ar', '16000',
+                'pipe:1'
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        self._pcm = bytearray()
+        self._lock = threading.Lock()
+        # stdout 需要另外一個 thread 持續讀取，否則 ffmpeg 會因 pipe 塞滿而卡住
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+    
+    def _read_loop(self):
+        while True:
+            data = self._process.stdout.read1(4096)
+            if not data:
+                break
+            with self._lock:
+                self._pcm.extend(data)
+    
+    def write(self, chunk):
+        self._process.stdin.write(chunk)
+        self._process.stdin.flush()
+    
+    def feed(self, chunk) -> bytes:
+        """
+        寫入 chunk 並取出目前新解碼出來的 PCM
+        pipe 塞滿時寫入會卡住，在 event loop 中請用 asyncio.to_thread 呼叫
+        """
+        self.write(chunk)
+        return self.read()
+    
+    def read(self) -> bytes:
+        """
+        取出目前為止新解碼出來的 PCM（只取完整的 sample，剩下的半個 sample 留到下次）
+        """
+        with self._lock:
+            size = len(self._pcm) - len(self._pcm) % 2
+            data = bytes(self._pcm[:size])
+            del self._pcm[:size]
+        return data
+    
+    def close(self) -> bytes:
+        """
+        結束輸入並等待 ffmpeg 把剩下的資料解碼完
+        """
+        try:
+            self._process.stdin.close()
+        except Exception:
+            pass
+        self._reader.join(timeout=5)
+        try:
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+        with self._lock:
+            data = bytes(self._pcm)
+            self._pcm.clear()
+        return data
+
+class WavStreamDecoder:
+    """
+    串流進來的是 16kHz, 16-bit PCM 的 wav 時使用：跳過檔頭後直接取出 PCM
+    （多聲道在 NumPy 中平均成單聲道），不需要啟動 ffmpeg；介面與 StreamDecoder 相同
+    """
+    def __init__(self, info:WavInfo):
+        self._channels = info.channels
+        self._skip = info.data_offset
+        self._remaining = info.data_length
+        self._pcm = bytearray()
+    
+    def write(self, chunk):
+        chunk = memoryview(chunk)
+        if self._skip:
+            skipped = min(self._skip, len(chunk))
+            chunk = chunk[skipped:]
+            self._skip -= skipped
+        if self._remaining is not None:
+            # data chunk 之後的其他 chunk（例如 LIST）不是音訊
+            chunk = chunk[:self._remaining]
+            self._remaining -= len(chunk)
+        self._pcm.extend(chunk)
+    
+    def feed(self, chunk) -> bytes:
+        self.write(chunk)
+        return self.read()
+    
+    def read(self) -> bytes:
+        frame_size = 2 * self._channels
+        size = len(self._pcm) - len(self._pcm) % frame_size
+        data = bytes(self._pcm[:size])
+        del self._pcm[:size]
+        if self._channels > 1:
+            frames = np.frombuffer(data, dtype="<i2").reshape(-1, self._channels)
+            data = frames.mean(axis=1).astype(np.int16).tobytes()
+        return data
+    
+    def close(self) -> bytes:
+        return self.read()
+
+def open_stream_decoder(first_chunk, sample_rate=16000):
+    """
+    依第一個 chunk 的檔頭選擇解碼方式：
+    16-bit PCM、取樣率正確的 wav 直接取出 PCM，其他格式（webm / opus ...）交給常駐的 ffmpeg
+    呼叫端仍然要把 first_chunk 寫進回傳的 decoder
+    """
+    if sniff_audio_format(first_chunk) == "wav":
+        info = parse_wav_header(first_chunk)
+        if info is not None and info.format_tag == 1 and info.sample_width == 2 and info.sample_rate == sample_rate:
+            return WavStreamDecoder(info)
+    return StreamDecoder()
 
 # 音檔檢查
 def get_audio_info(file_path):
@@ -87,23 +356,74 @@ def reduce_noise(input_file, output_file):
     reduced_noise = nr.reduce_noise(y=audio, sr=sample_rate, prop_decrease=0.5, stationary=True)
     sf.write(output_file, reduced_noise, sample_rate)
     
+# Demucs 模型在整個 process 中只載入一次
+DEMUCS_MODEL_NAME = "htdemucs"
+DEMUCS_CPU_THREADS = 4 # 沒有 GPU 時 torch 使用的 thread 數，避免佔滿所有核心
+_demucs_model = None
+_demucs_lock = threading.Lock()
+_demucs_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def get_demucs_model():
+    """
+    第一次呼叫時才載入模型，之後都回傳同一個（已經是 eval 模式）
+    """
+    global _demucs_model
+    if _demucs_model is None:
+        with _demucs_lock:
+            if _demucs_model is None:
+                if _demucs_device == 'cpu':
+                    torch.set_num_threads(DEMUCS_CPU_THREADS)
+                model = pretrained.get_model(DEMUCS_MODEL_NAME)
+                model.to(_demucs_device)
+                model.eval()
+                _demucs_model = model
+    return _demucs_model
+
+def separate_vocals(wav, sample_rate, chunked=False):
+    """
+    只取出人聲音軌
+    Args:
+        wav: (channels, samples) 的 torch.Tensor
+        sample_rate: wav 的取樣率
+        chunked: 短片段（串流）模式，不做 shift 平均、重疊也比較少，速度約快一倍
+    Returns:
+        torch.Tensor: 與輸入相同取樣率/聲道數的人聲
+    """
+    model = get_demucs_model()
+    channels = wav.shape[0]
+    mix = convert_audio(wav, sample_rate, model.samplerate, model.audio_channels)
+    # 與 demucs 官方 CLI 相同，先正規化再分離
+    ref = mix.mean(0)
+    mean, std = ref.mean(), ref.std() + 1e-8
+    mix = (mix - mean) / std
+    with torch.no_grad():
+        if chunked:
+            sources = apply_model(model, mix[None], device=_demucs_device, shifts=0, split=True, overlap=0.1)
+        else:
+            sources = apply_model(model, mix[None], device=_demucs_device, shifts=1, split=True, overlap=0.25)
+    # 模型一次會分離出全部四個音軌（drums / bass / other / vocals），這裡只保留人聲，其他的不寫檔也不回傳
+    vocals = sources[0, model.sources.index("vocals")] * std + mean
+    return convert_audio(vocals.cpu(), model.samplerate, sample_rate, channels)
+
+def isolate_voice_pcm(pcm_bytes, sample_rate=16000, chunked=True) -> bytes:
+    """
+    16-bit 單聲道 PCM 進、16-bit 單聲道 PCM 出，全程在記憶體中
+    """
+    if len(pcm_bytes) == 0:
+        return b""
+    wav = torch.frombuffer(bytearray(pcm_bytes), dtype=torch.int16).float().div_(32768.0)[None]
+    vocals = separate_vocals(wav, sample_rate, chunked=chunked)
+    return (vocals[0].clamp(-1.0, 1.0) * 32767.0).to(torch.int16).numpy().tobytes()
+
 def isolate_voice(input_file, output_dir):
     # 确保输出目录存在
     os.makedirs(output_dir, exist_ok=True)
     
-    model = pretrained.get_model("htdemucs")
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model.to(device)
-    
     wav, sr = torchaudio.load(input_file)
-    sources = apply_model(model, wav.unsqueeze(0), device=device, overlap=0.25, shifts=1, split=True)
-    
-    # sources的顺序为：[drums, bass, other, vocals]
-    source_names = ["drums", "bass", "other", "vocals"]
+    vocals = separate_vocals(wav, sr)
     
-    # 保存所有分离的音轨
-    for source, name in zip(sources[0], source_names):
-        output_path = os.path.join(output_dir, f"{name}.wav")
-        torchaudio.save(output_path, source, sr)
+    # 只保存会用到的人声音轨
+    output_path = os.path.join(output_dir, "vocals.wav")
+    torchaudio.save(output_path, vocals, sr)
     
-    return os.path.join(output_dir, "vocals.wav")
+    return output_path
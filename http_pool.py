@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import deepl
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 所有對外翻譯/轉錄請求共用的連線設定
+HTTP_TIMEOUT = (3.05, 10) # (連線, 讀取) 秒
+OPENAI_TIMEOUT = 60.0 # 秒，轉錄較長的片段需要比較久
+POOL_SIZE = 32 # 每個 host 保持的 keep-alive 連線數
+MAX_CONCURRENT_REQUESTS = 16 # 同時在 thread 中執行的阻塞式請求上限
+
+_session = None
+_session_lock = threading.Lock()
+_limiter = None
+
+def get_http_session() -> requests.Session:
+    """
+    共用的 requests.Session：重複使用 TCP/TLS 連線，不必每次重新握手
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=8,
+                    pool_maxsize=POOL_SIZE,
+                    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False) # 重試完仍失敗時回傳最後的 response，不丟例外
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def configure_deepl():
+    """
+    DeepL SDK 內部已經使用 keep-alive 的 requests.Session，這裡只調整逾時與重試次數
+    """
+    deepl.http_client.min_connection_timeout = HTTP_TIMEOUT[1]
+    deepl.http_client.max_network_retries = 2
+
+def _get_limiter() -> asyncio.Semaphore:
+    # Semaphore 只能在同一個 event loop 中使用
+    global _limiter
+    loop = asyncio.get_running_loop()
+    if _limiter is None or _limiter[0] is not loop:
+        _limiter = (loop, asyncio.Semaphore(MAX_CONCURRENT_REQUESTS))
+    return _limiter[1]
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    在 thread 中執行同步的 SDK 呼叫，避免卡住 event loop，並限制同時進行的數量
+    """
+    async with _get_limiter():
+        return await asyncio.to_thread(func, *args, **kwargs)
@@ -1,22 +1,75 @@
-import os
 import time
-import shutil
+import asyncio
+import threading
 import json
+from contextlib import asynccontextmanager
 import deepl
-from openai import OpenAI
-from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect 
+from openai import OpenAI, AsyncOpenAI
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect 
 from fastapi.middleware.cors import CORSMiddleware
 from Stt import STT, meeting_translator, LANGUAGES
-from process_audio import process_audio_file, AudioStream2
-from function import get_keywords, merge_audio_files, get_audio_info, reduce_noise, isolate_voice, save_as_wav, save_to_wav
+from process_audio import iter_audio_segments, AudioStream, SegmentPipeline
+from function import get_keywords, merge_audio_files, isolate_voice_pcm, get_demucs_model, open_stream_decoder
 from Key import OpenAI_API_KEY, DEEPL_API_KEY
-from Stt import get_keywords_from_dict, get_keywords_dictionary, pattern_finder
+from session import SessionRegistry
+from session_output import SessionOutput
+from meeting_store import meeting_store
+from messages import segment_entry, delta_message, resync_message, event_message, session_entries, keyword_positions
+from translation_cache import translation_cache
+from http_pool import configure_deepl, run_blocking, OPENAI_TIMEOUT
+from stt_backends import openai_backend, local_whisper_backend
 
-openai_client = OpenAI(api_key=OpenAI_API_KEY)
+openai_client = OpenAI(api_key=OpenAI_API_KEY, timeout=OPENAI_TIMEOUT)
+openai_async_client = AsyncOpenAI(api_key=OpenAI_API_KEY, timeout=OPENAI_TIMEOUT)
+configure_deepl()
 deepl_client = deepl.Translator(DEEPL_API_KEY)
-translator_meeting = meeting_translator(openai_client, deepl_client)
 
-app = FastAPI()
+# 語音辨識引擎："openai" 使用 Whisper API，"local" 在本機 CPU 上跑量化的 Whisper（不需要網路）
+STT_BACKEND = "openai"
+if STT_BACKEND == "local":
+    stt_backend = local_whisper_backend()
+    stt_backend.warmup()
+else:
+    stt_backend = openai_backend(openai_client, openai_async_client)
+
+# 翻譯快取：記憶體 LRU + SQLite，重新啟動後仍然有效
+translator_meeting = meeting_translator(openai_client, deepl_client, cache=translation_cache(db_path="translation_cache.db"), stt_backend=stt_backend)
+# 過期的 /ws/stream session 把最後還沒轉錄的句子處理完（finish_expired_session 定義在下面）
+sessions = SessionRegistry(on_expire=lambda session: finish_expired_session(session))
+# 所有會議的片段、翻譯與關鍵字，可以跨會議搜尋
+meeting_db = meeting_store(db_path="meetings.db")
+
+SAMPLE_RATE = 16000 # 斷句後的片段都是 16kHz mono 16-bit PCM
+
+# /ws/upload 同時處理的片段數量上限
+MAX_CONCURRENT_SEGMENTS = 4
+
+# /ws/stream 轉錄前先用 Demucs 去掉背景音（模型在啟動時就先載入）
+ENABLE_VOICE_ISOLATION = False
+if ENABLE_VOICE_ISOLATION:
+    get_demucs_model()
+
+async def sweep_sessions():
+    """
+    定期讓斷線超過 ttl 的 session 過期（伺服器沒有新連線時也會處理），並刪除超過保留期限的 session 目錄
+    """
+    while True:
+        await asyncio.sleep(max(sessions.ttl / 2, 1))
+        try:
+            sessions.purge_expired()
+            await asyncio.to_thread(sessions.remove_stale_directories)
+        except Exception as e:
+            print(f"Error expiring sessions: {e}")
+
+@asynccontextmanager
+async def lifespan(app):
+    sweeper = asyncio.create_task(sweep_sessions())
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS(跨來源資源共享)
 app.add_middleware(
@@ -27,309 +80,503 @@ app.add_middleware(
     allow_headers=["*"],  # 允許所有自訂標頭
 )
 
-def save_chinese_translation(text, filename="chinese_translation.txt"):
-    try:
-        # 使用 'a' 模式來追加內容而不是覆蓋
-        with open(filename, 'a', encoding='utf-8') as file:
-            file.write(text + '\n')  # 每次寫入後換行
-        # print(f"翻譯已成功追加到 {filename}")
-    except Exception as e:
-        print(f"儲存文件時發生錯誤：{str(e)}")
+def keyword_names(keyword_nums, language):
+    """
+    關鍵字編號 -> 關鍵字本身（寫入輸出檔用）
+    """
+    num_dict = translator_meeting._num_dict[language]
+    return [num_dict[keyword_num][0] for keyword_num in keyword_nums]
 
-def save_keywords(keywords, filename="keywords.txt"):
-    try:
-        # 使用 'a' 模式來追加內容而不是覆蓋
-        with open(filename, 'a', encoding='utf-8') as file:
-            for keyword in keywords:
-                file.write(keyword + '\n')  # 每個關鍵字寫入後換行
-        print(f"關鍵字已成功追加到 {filename}")
-    except Exception as e:
-        print(f"儲存關鍵字時發生錯誤：{str(e)}")
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return translator_meeting._translation_cache.stats()
+
+@app.get("/api/meetings/search")
+async def search_meetings(q: str, language: str = None, meeting_id: str = None, limit: int = 50):
+    """
+    搜尋所有會議的原文與翻譯
+    """
+    return {"results": await asyncio.to_thread(meeting_db.search, q, language, meeting_id, limit)}
+
+@app.get("/api/keywords/{keyword_id}/segments")
+async def keyword_segments(keyword_id: int, meeting_id: str = None, limit: int = 100):
+    """
+    提到某個關鍵字的所有片段（使用索引，不用掃過文字）
+    """
+    return {"results": await asyncio.to_thread(meeting_db.segments_with_keyword, keyword_id, meeting_id, limit)}
 
-# 使用示例
-# chinese_text = "這是一個測試文本。這裡可以放入你的中文翻譯。"
-# save_chinese_translation(chinese_text)
+@app.get("/api/meetings/{meeting_id}")
+async def get_meeting(meeting_id: str):
+    meeting = await asyncio.to_thread(meeting_db.get_meeting, meeting_id)
+    if meeting is None:
+        raise HTTPException(status_code=404, detail="Meeting not found")
+    return meeting
+
+async def store_segment(meeting_id, segment_id, segment, source_language, original_text, chinese_translation, keyword_matches):
+    """
+    定案的片段寫進 meeting_db（在 thread 中，不卡住 event loop）
+    """
+    await asyncio.to_thread(
+        meeting_db.add_segment, meeting_id, segment_id, source_language, original_text,
+        start_time=segment.start / 2 / SAMPLE_RATE, end_time=segment.end / 2 / SAMPLE_RATE,
+        translations={LANGUAGES.TAIWANESE.value: chinese_translation}, keyword_hits=keyword_matches
+    )
+
+async def transcribe_and_translate(stt_model, pcm, target_language=LANGUAGES.TAIWANESE.value, previous_language=None, language_ready=None):
+    """
+    轉錄一段音訊並翻譯，OpenAI / DeepL 的請求都不會卡住 event loop
+    Args:
+        previous_language: 前一段的語言（或還在處理中的前一段的 language_ready），
+            Whisper 沒有回報支援的語言、改用文字偵測時，短句或不確定時沿用前一段的語言
+        language_ready: 決定這一段的語言後設定的 Future，給下一段使用
+    Returns:
+        (原文, 語言, 翻譯, 原文中的關鍵字 [keyword_match])，關鍵字每段只比對一次
+    """
+    try:
+        result = await stt_model.atranscript_result(pcm)
+        segment_text = result.text
+        print(segment_text)
+        # Whisper 已經從音訊判斷出語言時不需要等前一段
+        if result.language is None and isinstance(previous_language, asyncio.Future):
+            previous_language = await asyncio.shield(previous_language)
+        source_language = translator_meeting.source_language(result, previous_language)
+    except BaseException:
+        # 失敗時下一段不用再等這一段，直接自己偵測
+        if language_ready is not None and not language_ready.done():
+            language_ready.set_result(None)
+        raise
+    if language_ready is not None:
+        language_ready.set_result(source_language)
+    keyword_matches = translator_meeting._keyword_finder.find_matches(segment_text, source_language)
+    translation = await translator_meeting.atranslate_by_text(
+        segment_text,
+        source_language=source_language,
+        target_language=target_language,
+        keyword_nums=[match.id for match in keyword_matches]
+    )
+    return segment_text, source_language, translation, keyword_matches
 
 @app.websocket("/ws/upload")
 async def upload_audio(websocket: WebSocket):
+    # 每個連線有自己的 session，中間檔案與結果不會跟其他會議互相覆蓋
+    session = sessions.create()
+    tasks = []
+    producer = None
+    # 連線結束時設定：斷句的 thread 取消 task 也不會停，要靠它停止產生新的片段
+    closing = threading.Event()
+    output = SessionOutput(session.scratch_dir)
     try:
         await websocket.accept()
-        
-        original = []
-        chinese = []
-        english = []
-        japan = []
-        german = []
-        
-        voice_input_path = "voice_input.wav"
-        voice_path_wav = "voice_output.wav"
-        output_dir_path = "./upload_output_segments"
+        await asyncio.to_thread(meeting_db.add_meeting, session.id, "upload")
         
         time_start = time.time()
         
-        # 清理輸出目錄
-        if os.path.exists(output_dir_path):
-            shutil.rmtree(output_dir_path)
-        os.makedirs(output_dir_path)
+        # 關鍵字只在啟動時讀取一次，excel 有更新時才重新載入
+        translator_meeting.refresh_keywords()
         
         # 初始化 STT 模型
-        stt_model = STT(openai_client, keywords=get_keywords())
-        
-        # 獲取關鍵字字典
-        keyword_dict, _ = get_keywords_dictionary()
-
-        # 初始化 pattern_finder
-        keyword_finder = pattern_finder(keyword_dict)
-        
-        # 初始化一個集合來存儲所有檢測到的關鍵字
-        all_detected_keywords = set()
+        stt_model = STT(openai_client, keywords=get_keywords(), backend=stt_backend)
         
         try:
-            # 接收音頻文件
-            content = await websocket.receive_bytes()
+            # 同時轉錄/翻譯多個片段（最多 MAX_CONCURRENT_SEGMENTS 個），但依片段順序送出結果
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEGMENTS)
             
-            # print('input_bytes length:', len(content))
+            async def process_segment(segment, previous_language, language_ready):
+                async with semaphore:
+                    return await transcribe_and_translate(stt_model, segment.pcm, previous_language=previous_language, language_ready=language_ready)
             
-            # 保存音頻文件
-            with open(voice_input_path, "wb") as f_out:
-                f_out.write(content)
-            print(f"Received file, size = {len(content)} bytes")
+            # 每斷出一句就立刻開始轉錄
+            loop = asyncio.get_running_loop()
+            task_queue = asyncio.Queue()
             
-            # 處理音頻
-            merge_audio_files(voice_input_path, voice_path_wav)
-            segments = process_audio_file(voice_path_wav, output_dir_path)
+            # 轉錄同時進行，語言偵測則依片段順序，每一段都參考前一段的語言
+            previous_language = None
             
-            print(segments)
+            def schedule(segment):
+                nonlocal previous_language
+                if closing.is_set():
+                    return
+                language_ready = loop.create_future()
+                task = asyncio.create_task(process_segment(segment, previous_language, language_ready))
+                previous_language = language_ready
+                tasks.append(task)
+                task_queue.put_nowait((segment, task))
             
-            main_transcript = []
+            # 整個檔案一次送來：降噪與斷句在 thread 中分區塊進行
+            def produce_segments(pcm):
+                try:
+                    for segment in iter_audio_segments(pcm):
+                        if closing.is_set():
+                            break
+                        loop.call_soon_threadsafe(schedule, segment)
+                finally:
+                    loop.call_soon_threadsafe(task_queue.put_nowait, None)
             
-            if os.path.exists("chinese_translation.txt"):
-                os.remove("chinese_translation.txt")
+            # 分段上傳：{"type": "start"}、多個 binary chunk、{"type": "end"}
+            # 每個 chunk 收到就解碼、降噪、斷句，檔案還沒傳完前面的句子就開始轉錄
+            # 解碼是串流式的，mp4/m4a 這類 metadata 在檔尾的格式請用整個檔案上傳
+            async def receive_chunks():
+                decoder = None
+                pipeline = SegmentPipeline(max_segment_seconds=None) # 跟整個檔案上傳的斷句結果一致
+                received = 0
+                try:
+                    while True:
+                        message = await websocket.receive()
+                        if message["type"] == "websocket.disconnect":
+                            raise WebSocketDisconnect(message.get("code", 1000))
+                        if message.get("text") is not None:
+                            if json.loads(message["text"]).get("type") == "end":
+                                break
+                            continue
+                        chunk = message.get("bytes") or b""
+                        if not chunk:
+                            continue
+                        received += len(chunk)
+                        if decoder is None:
+                            decoder = open_stream_decoder(chunk)
+                        # 寫入 ffmpeg 的 pipe 可能會卡住，解碼與斷句都在 thread 中進行
+                        for segment in await asyncio.to_thread(lambda: pipeline.feed(decoder.feed(chunk))):
+                            schedule(segment)
+                    print(f"Received file in chunks, size = {received} bytes")
+                    pcm = b""
+                    if decoder is not None:
+                        pcm = await asyncio.to_thread(decoder.close)
+                        decoder = None
+                    for segment in await asyncio.to_thread(lambda: pipeline.feed(pcm) + pipeline.flush()):
+                        schedule(segment)
+                finally:
+                    if decoder is not None:
+                        decoder.close()
+                    task_queue.put_nowait(None)
+            
+            # 第一則訊息決定上傳方式，直接送 bytes 則是整個檔案（舊的用法）
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("text") is not None and json.loads(message["text"]).get("type") == "start":
+                producer = asyncio.create_task(receive_chunks())
+            else:
+                # 接收音頻文件
+                content = message.get("bytes") or b""
+                print(f"Received file, size = {len(content)} bytes")
+                # 處理音頻（全程在記憶體中，不寫暫存檔）
+                pcm = await asyncio.to_thread(merge_audio_files, content)
+                producer = asyncio.create_task(asyncio.to_thread(produce_segments, pcm))
             
             # 處理每個片段
-            for segment_file in sorted(os.listdir(output_dir_path), key=lambda x: int(x.split("_")[1].split(".")[0])):
-                segment_path = os.path.join(output_dir_path, segment_file)
+            while (item := await task_queue.get()) is not None:
+                segment, task = item
+                segment_text, source_language, chinese_translation, keyword_matches = await task
+                detected_keywords = [match.id for match in keyword_matches]
                 
-                with open(segment_path, "rb") as f:
-                    segment_text = stt_model.transcript(f)
-                    print(segment_text)
-                    
-                    source_language = translator_meeting._language_detector.detect_language_text(segment_text)
-                    chinese_translation = translator_meeting.translate_by_text(
-                        segment_text,
-                        source_language=source_language,
-                        target_language=LANGUAGES.TAIWANESE.value
-                    )
-                    translator_meeting.__make_keyword_output__(translator_meeting._keyword_finder.find_pattern(segment_text, source_language), translator_meeting._num_dict, source_language)
-                    
-                    original.append(segment_text)
-                    chinese.append(chinese_translation)
-                    
-                    # 檢測關鍵字
-                    detected_keywords = keyword_finder.find_pattern(segment_text, source_language)
-                    
-                    # 將檢測到的關鍵字添加到集合中
-                    all_detected_keywords.update(detected_keywords)
-                    
-                    # 發送翻譯結果
-                    main_transcript.append(chinese_translation)
-                    save_chinese_translation(chinese_translation)
-                    await websocket.send_json(main_transcript)
+                segment_id = session.add_segment(segment_text, source_language)
+                session.add_translation(LANGUAGES.TAIWANESE.value, chinese_translation)
+                session.add_keywords(detected_keywords)
+                output.write_segment(segment_id, source_language, segment_text, chinese_translation,
+                                     detected_keywords, keyword_names(detected_keywords, source_language),
+                                     start_time=segment.start / 2 / SAMPLE_RATE, end_time=segment.end / 2 / SAMPLE_RATE)
+                
+                # 發送翻譯結果（只有這個片段）
+                await websocket.send_json(delta_message(session.next_seq(), [
+                    segment_entry(segment_id, LANGUAGES.TAIWANESE.value, chinese_translation, original=segment_text,
+                                  source_language=source_language, keywords=keyword_positions(keyword_matches))
+                ]))
+                await store_segment(session.id, segment_id, segment, source_language, segment_text, chinese_translation, keyword_matches)
 
-            for i, text in enumerate(original):
-                english_translation = translator_meeting.translate_by_text(
-                    text,
-                    source_language=source_language,
-                    target_language=LANGUAGES.ENGLISH.value
-                )
-                japanese_translation = translator_meeting.translate_by_text(
-                    text,
-                    source_language=source_language,
-                    target_language=LANGUAGES.JAPANESE.value
-                )
-                german_translation = translator_meeting.translate_by_text(
-                    text,
-                    source_language=source_language,
-                    target_language=LANGUAGES.GERMAN.value
-                )
-            
-                english.append(english_translation)
-                japan.append(japanese_translation)
-                german.append(german_translation)
+            # 斷句發生錯誤時在這裡拋出
+            await producer
+
+            # 其他語言：所有片段 x 所有語言同時翻譯，每段使用自己偵測到的語言
+            other_languages = [LANGUAGES.ENGLISH.value, LANGUAGES.JAPANESE.value, LANGUAGES.GERMAN.value]
+            other_translations = await run_blocking(
+                translator_meeting.translate_texts_multi_language,
+                session.original,
+                session.source_languages,
+                other_languages
+            )
+            other_entries = []
+            stored_translations = dict()
+            for target_language in other_languages:
+                for segment_id, translation in enumerate(other_translations[target_language]):
+                    session.add_translation(target_language, translation)
+                    other_entries.append(segment_entry(segment_id, target_language, translation))
+                    stored_translations.setdefault(segment_id, dict())[target_language] = translation
+            await websocket.send_json(delta_message(session.next_seq(), other_entries))
+            await asyncio.to_thread(meeting_db.add_translations, session.id, stored_translations)
 
             # 保存所有檢測到的關鍵字
-            save_keywords(all_detected_keywords)
+            all_detected_keywords = session.detected_keywords()
+            output.write_keywords(keyword_names(sorted(all_detected_keywords), LANGUAGES.TAIWANESE.value))
 
             # 發送關鍵字結果
-            await websocket.send_json({
-                "event": "keywords",
-                "keywords": list(all_detected_keywords)
-            })
+            await websocket.send_json(event_message("keywords", session.next_seq(), keywords=list(all_detected_keywords)))
             
-            # 只在最後發送一次完整的翻譯結果
+            # 所有翻譯都已經以 delta 送出，這裡只通知處理完成
             time_end = time.time()
             runtime = time_end-time_start
-            await websocket.send_json({
-                "event": "complete",
-                "translations": {
-                    # "original": original,
-                    "chinese": chinese,
-                    "english": english,
-                    "japan": japan,
-                    "german": german
-                },
-                "runtime": runtime
-            })
+            await websocket.send_json(event_message("complete", session.next_seq(), segment_count=len(session.original), runtime=runtime))
             
             print(f"Program runtime {runtime//60} minutes, {runtime%60} seconds")
             
+        except WebSocketDisconnect:
+            raise
         except Exception as e:
             print(f"Error processing audio: {e}")
-            await websocket.send_json({
-                "event": "error",
-                "error": str(e)
-            })
+            await websocket.send_json(event_message("error", session.next_seq(), error=str(e)))
             
     except WebSocketDisconnect:
         print("Client disconnected")
     finally:
+        # 連線中斷時取消還沒完成的接收與片段
+        closing.set()
+        if producer is not None:
+            producer.cancel()
+        for task in tasks:
+            task.cancel()
+        await output.close()
+        sessions.close(session.id)
         await websocket.close()
 
+async def transcribe_stream_segment(session, stt_model, segment):
+    """
+    /ws/stream 轉錄一個片段，沿用 session 最後一段的語言
+    """
+    pcm = segment.pcm
+    if ENABLE_VOICE_ISOLATION:
+        pcm = await asyncio.to_thread(isolate_voice_pcm, pcm)
+    previous_language = session.source_languages[-1] if session.source_languages else None
+    return await transcribe_and_translate(stt_model, pcm, previous_language=previous_language)
+
+async def finalize_stream_segment(session, stt_model, segment, output):
+    """
+    定案一個片段：轉錄、翻譯，記錄到 session / 輸出檔 / meeting_db
+    Returns:
+        送給前端的 entry
+    """
+    transcript, source_language, chinese_translation, keyword_matches = await transcribe_stream_segment(session, stt_model, segment)
+    segment_id = session.add_segment(transcript, source_language)
+    session.add_translation(LANGUAGES.TAIWANESE.value, chinese_translation)
+    detected_keywords = [match.id for match in keyword_matches]
+    session.add_keywords(detected_keywords)
+    output.write_segment(segment_id, source_language, transcript, chinese_translation,
+                         detected_keywords, keyword_names(detected_keywords, source_language),
+                         start_time=segment.start / 2 / SAMPLE_RATE, end_time=segment.end / 2 / SAMPLE_RATE)
+    await store_segment(session.id, segment_id, segment, source_language, transcript, chinese_translation, keyword_matches)
+    return segment_entry(segment_id, LANGUAGES.TAIWANESE.value, chinese_translation, original=transcript,
+                         source_language=source_language, keywords=keyword_positions(keyword_matches))
+
+async def close_stream(session, decoder, output, ended):
+    """
+    /ws/stream 連線結束時的收尾
+    """
+    try:
+        if decoder is not None:
+            # ffmpeg 結束最多要等幾秒，不能卡住其他連線
+            # 解碼器裡剩下的音訊接著斷句，斷出來的句子留到重新連線或過期時再轉錄
+            try:
+                segments = await asyncio.to_thread(lambda: session.audio_stream.feed(decoder.close()))
+                session.pending_segments.extend(segments)
+            except Exception as e:
+                print(f"Error closing decoder: {e}")
+        await output.close()
+    finally:
+        if ended:
+            sessions.close(session.id)
+        else:
+            # 保留 session，ttl 內可以重新連線
+            sessions.detach(session.id)
+
+# 背景處理過期 session 的 task，保留參考避免被 GC
+_expire_tasks = set()
+
+def finish_expired_session(session):
+    """
+    session 過期（斷線後沒有在 ttl 內重新連線）時，把還沒定案的句子轉錄完
+    由 SessionRegistry 在 event loop 中呼叫
+    """
+    if session.audio_stream is None:
+        return
+    segments = session.pending_segments + session.audio_stream.flush()
+    session.pending_segments = []
+    if not segments:
+        return
+    
+    async def finish():
+        output = SessionOutput(session.scratch_dir)
+        try:
+            stt_model = STT(openai_client, keywords=get_keywords(), backend=stt_backend)
+            for segment in segments:
+                await finalize_stream_segment(session, stt_model, segment, output)
+        except Exception as e:
+            print(f"Error finishing expired session {session.id}: {e}")
+        finally:
+            await output.close()
+    
+    task = asyncio.get_running_loop().create_task(finish())
+    _expire_tasks.add(task)
+    task.add_done_callback(_expire_tasks.discard)
+
 @app.websocket("/ws/stream")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, session_id: str = None, last_segment_id: int = None):
+    """
+    即時串流翻譯，訊息格式見 messages.py，每則 delta 只包含一個片段：
+        final=False  還在說的句子（之後可能再更新）
+        final=True   VAD 斷句後定案，取代同一個 segment_id 之前所有的 interim
+    前端送 {"type": "resync"} 時回傳所有已定案的片段
+    會議結束時送 {"type": "end"}：還沒說完的句子也會定案，送出 complete 後關閉 session
+    斷線後在 ttl 內用 /ws/stream?session_id=...&last_segment_id=... 重新連線，
+    會補送之後已定案的片段（不會重新轉錄），還沒說完的句子也會接著處理
+    沒有重新連線、session 過期時，剩下的句子會在背景轉錄並寫進輸出檔與 meeting_db
+    """
+    decoder = None
+    interim_task = None
+    ended = False
+    session = sessions.resume(session_id) if session_id else None
+    resumed = session is not None
+    if session_id and not resumed and sessions.get(session_id) is not None:
+        # 這個 session 還有其他連線連著，不接手也不另開新的 session
+        await websocket.accept()
+        await websocket.send_json(event_message("error", 0, error=f"Session {session_id} is already connected"))
+        await websocket.close(code=1008)
+        return
+    if session is None:
+        session = sessions.create()
+    # 每個連線各自的 writer，重新連線後接著寫同一個 session 的檔案
+    output = SessionOutput(session.scratch_dir)
     try:
         await websocket.accept()
+        await asyncio.to_thread(meeting_db.add_meeting, session.id, "stream")
+        await websocket.send_json(event_message("session", session.next_seq(), session_id=session.id, resumed=resumed, ttl=sessions.ttl))
+        if resumed:
+            # 沒有指定時，從前端最後 ack 的片段之後開始補送
+            acked = session.acked_segment_id if last_segment_id is None else max(-1, last_segment_id)
+            await websocket.send_json(delta_message(session.next_seq(), session_entries(session, acked)))
+        
+        # 關鍵字只在啟動時讀取一次，excel 有更新時才重新載入
+        translator_meeting.refresh_keywords()
         
         # 初始化 STT 模型
-        stt_model = STT(openai_client, keywords=get_keywords())
-        audio_chunks = []
+        stt_model = STT(openai_client, keywords=get_keywords(), backend=stt_backend)
         accumulated_size = 0
-        max_chunk_size = 32000       
-        buffer = b''
+        max_chunk_size = 32000
+        
+        # 解碼與斷句都保留狀態，每個 chunk 只處理新進來的音訊
+        # 重新連線時前端會送新的音訊檔頭，所以 decoder 每次連線重建（依第一個 chunk 的格式），斷句狀態則保留在 session 中
+        if session.audio_stream is None:
+            session.audio_stream = AudioStream()
+        audio_stream = session.audio_stream
+        
+        async def send_finals(segments, start_time):
+            # 已經斷句的句子：依序轉錄並送出定案結果
+            for segment in segments:
+                entry = await finalize_stream_segment(session, stt_model, segment, output)
+                entry["runtime"] = time.time() - start_time
+                print(f"Segment {entry['segment_id']}: {entry['text']}, Runtime = {entry['runtime']}")
+                await websocket.send_json(delta_message(session.next_seq(), [entry]))
         
-        save_transcript = False
-        all_transcript = []
+        # 上次斷線時才斷出來的句子
+        if session.pending_segments:
+            segments, session.pending_segments = session.pending_segments, []
+            await send_finals(segments, time.time())
         
-        audio_stream = AudioStream2()
+        # 最後一次送出的 interim：(segment_id, 音訊範圍, 翻譯)
+        last_interim = (None, None, None)
         
-        output_dir_path = "./ws_output_segments"
-        if os.path.exists(output_dir_path):
-            shutil.rmtree(output_dir_path)
-            os.makedirs(output_dir_path)
+        async def send_interim(segment_id, segment, start_time):
+            nonlocal last_interim
+            try:
+                _, _, chinese_translation, _ = await transcribe_stream_segment(session, stt_model, segment)
+            except Exception as e:
+                print(f"Error transcribing interim segment: {e}")
+                return
+            # 轉錄期間這句已經定案，或內容沒有改變，就不用再送
+            if segment_id != len(session.original) or (segment_id, chinese_translation) == (last_interim[0], last_interim[2]):
+                return
+            last_interim = (segment_id, (segment.start, segment.end), chinese_translation)
+            await websocket.send_json(delta_message(session.next_seq(), [
+                segment_entry(segment_id, LANGUAGES.TAIWANESE.value, chinese_translation, final=False, runtime=time.time() - start_time)
+            ]))
         
         while True:
             try:
-                # 接收音頻
-                audio_chunk = await websocket.receive_bytes()
+                # 接收音頻，文字訊息為控制指令
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+                if message.get("text") is not None:
+                    command = json.loads(message["text"])
+                    if command.get("type") == "resync":
+                        await websocket.send_json(resync_message(session.next_seq(), session))
+                    elif command.get("type") == "end":
+                        # 會議結束：最後一句不等 VAD 斷句，直接定案
+                        if interim_task is not None:
+                            interim_task.cancel()
+                        pcm = b""
+                        if decoder is not None:
+                            pcm = await asyncio.to_thread(decoder.close)
+                            decoder = None
+                        start_time = time.time()
+                        try:
+                            await send_finals(await asyncio.to_thread(lambda: audio_stream.feed(pcm) + audio_stream.flush()), start_time)
+                        except Exception as e:
+                            print(f"Error transcribing audio: {e}")
+                            await websocket.send_json(event_message("error", session.next_seq(), error=str(e)))
+                        await websocket.send_json(event_message("complete", session.next_seq(), segment_count=len(session.original), runtime=time.time() - start_time))
+                        ended = True
+                        break
+                    elif command.get("type") == "ack":
+                        # 只接受已定案的片段編號
+                        session.acked_segment_id = max(session.acked_segment_id, min(int(command["segment_id"]), len(session.original) - 1))
+                    continue
+                audio_chunk = message.get("bytes") or b""
                 print(f"Received audio chunk of size {len(audio_chunk)} bytes")
                 
                 if len(audio_chunk) == 0:
                     print("Received empty chunk, skipping")
                     continue
-                # 將audio_chunk判斷是否包含斷句
-                # print(audio_stream.streaming_sentence_detector(audio_chunk, 16000, output_dir_path))
-                    
-                buffer += audio_chunk
-                audio_chunks.append(audio_chunk)
-                accumulated_size += len(audio_chunk)
                 
-                print(f"Accumulated size: {accumulated_size}")
+                start_time = time.time()
                 
-                if accumulated_size >= max_chunk_size:
-                    start_time = time.time()
-                    
-                    complete_audio = buffer
-                    if os.path.exists("complete_audio.wav"):
-                        os.remove("complete_audio.wav")
-                        
-                    with open("complete_audio.wav", "wb") as f:
-                        f.write(complete_audio)
-                    
-                    # save_to_wav(complete_audio, "complete_audio.wav")
-                    
-                    # isolated_dir = "isolated_audio"
-                    # os.makedirs(isolated_dir, exist_ok=True)
-                    
-                    # vocals_path = isolate_voice("complete_audio.wav", isolated_dir)
-                    
-                    if os.path.exists("complete_output_audio.wav"):
-                        os.remove("complete_output_audio.wav")
-                    
-                    merge_audio_files("complete_audio.wav", "complete_output_audio.wav")
-                    
-                    save_transcript = audio_stream.streaming_sentence_detector("complete_output_audio.wav", output_dir_path)
-                    
-                    print(save_transcript)
-                    
-                    # STT
-                    try:
-                        if os.path.exists("./ws_output_segments/segment.wav"):
-                            with open("./ws_output_segments/segment.wav", "rb") as f:
-                                transcript = stt_model.transcript(f)
-                            
-                            end_time = time.time()
-                            runtime = end_time - start_time
-                            print(f"Transcript: {all_transcript}, Runtime = {runtime}")
-                            source_language = translator_meeting._language_detector.detect_language_text(transcript)
-                            
-                            chinese_translation = translator_meeting.translate_by_text(
-                                transcript,
-                                source_language=source_language,
-                                target_language=LANGUAGES.TAIWANESE.value
-                            )
-                                # english_translation = translator_meeting.translate_by_text(
-                                #     transcript,
-                                #     source_language=source_language,
-                                #     target_language=LANGUAGES.ENGLISH.value
-                                # )
-                                # japanese_translation = translator_meeting.translate_by_text(
-                                #     transcript,
-                                #     source_language=source_language,
-                                #     target_language=LANGUAGES.JAPANESE.value
-                                # )
-                                # german_translation = translator_meeting.translate_by_text(
-                                #     transcript,
-                                #     source_language=source_language,
-                                #     target_language=LANGUAGES.GERMAN.value
-                                # )
-                                
-                            if save_transcript == True:
-                                all_transcript.append(chinese_translation)
-                                response_data = {
-                                    "type": "SET_TRANSLATIONS",
-                                    "value": {
-                                        "transcript": all_transcript,
-                                        "runtime": runtime
-                                    }
-                                }
-                            else:
-                                response_data = {
-                                    "type": "SET_TRANSLATIONS",
-                                    "value": {
-                                        "transcript": all_transcript + [chinese_translation],
-                                        "runtime": runtime
-                                    }
-                                }
-                                
-                            await websocket.send_text(json.dumps(response_data))
-                    except Exception as e:
-                        print(f"Error transcribing audio: {e}")
-                        await websocket.send_text(f"Error: {str(e)}")
+                # 解碼新的音訊並判斷是否包含斷句
+                if decoder is None:
+                    decoder = open_stream_decoder(audio_chunk)
+                # 寫入 ffmpeg 的 pipe 可能會卡住，VAD 也是逐幀計算，都在 thread 中進行
+                segments = await asyncio.to_thread(lambda: audio_stream.feed(decoder.feed(audio_chunk)))
+                accumulated_size += len(audio_chunk)
+                
+                # STT
+                try:
+                    await send_finals(segments, start_time)
                     
-                    # 重置
-                    accumulated_size = 0
+                    # 還在說的句子，每累積 max_chunk_size 才更新一次
+                    # 在背景轉錄，不擋住接收；上一次還沒轉錄完、或音訊沒有變長時跳過
+                    if accumulated_size >= max_chunk_size:
+                        pending = audio_stream.pending()
+                        segment_id = len(session.original)
+                        if pending is not None and (interim_task is None or interim_task.done()) \
+                                and (segment_id, (pending.start, pending.end)) != last_interim[:2]:
+                            interim_task = asyncio.create_task(send_interim(segment_id, pending, start_time))
+                        # 重置
+                        accumulated_size = 0
+                except Exception as e:
+                    print(f"Error transcribing audio: {e}")
+                    await websocket.send_json(event_message("error", session.next_seq(), error=str(e)))
                 
             except WebSocketDisconnect:
                 print("WebSocket disconnected")
                 break
             except Exception as e:
                 print(f"Error processing chunk: {str(e)}")
-                await websocket.send_text(f"Error: {str(e)}")
+                await websocket.send_json(event_message("error", session.next_seq(), error=str(e)))
                 
     except Exception as e:
         print(f"WebSocket error: {str(e)}")
     finally:
+        if interim_task is not None:
+            interim_task.cancel()
+        # 收尾在另一個 task 中進行，handler 被取消時也會做完
+        await asyncio.shield(asyncio.ensure_future(close_stream(session, decoder, output, ended)))
         try:
             await websocket.close()
         except:
-            pass
\ No newline at end of file
+            pass
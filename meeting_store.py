@@ -0,0 +1,221 @@
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (keyword id, keyword language, start, end), Stt.keyword_match fits as is
+KeywordHit = Tuple[int, str, int, int]
+
+# every meeting's segments, source text, translations and keyword hits in one SQLite file
+# segment_texts holds the original text (kind "original") and every translation (kind "translation"),
+# segment_texts_fts indexes them for full text search. trigram tokens find words inside
+# chinese / japanese text too, which has no spaces between words
+# keyword_hits is indexed on keyword_id, "every segment mentioning keyword #7" doesn't scan any text
+class meeting_store(object):
+
+    def __init__(self, db_path:str="meetings.db"):
+        self._lock = threading.Lock()
+        # several batch worker processes may write to the same file
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30.0)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS meetings ("
+            "meeting_id TEXT PRIMARY KEY, source TEXT, created_at REAL, duration REAL);"
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "meeting_id TEXT REFERENCES meetings(meeting_id) ON DELETE CASCADE, segment_id INTEGER, "
+            "start_time REAL, end_time REAL, source_language TEXT, "
+            "PRIMARY KEY (meeting_id, segment_id));"
+            "CREATE TABLE IF NOT EXISTS segment_texts ("
+            "id INTEGER PRIMARY KEY, meeting_id TEXT, segment_id INTEGER, kind TEXT, language TEXT, text TEXT, "
+            "UNIQUE (meeting_id, segment_id, kind, language), "
+            "FOREIGN KEY (meeting_id, segment_id) REFERENCES segments(meeting_id, segment_id) ON DELETE CASCADE);"
+            "CREATE TABLE IF NOT EXISTS keyword_hits ("
+            "meeting_id TEXT, segment_id INTEGER, keyword_id INTEGER, language TEXT, start INTEGER, end INTEGER, "
+            "FOREIGN KEY (meeting_id, segment_id) REFERENCES segments(meeting_id, segment_id) ON DELETE CASCADE);"
+            "CREATE INDEX IF NOT EXISTS keyword_hits_keyword ON keyword_hits (keyword_id, meeting_id, segment_id);"
+            "CREATE INDEX IF NOT EXISTS keyword_hits_segment ON keyword_hits (meeting_id, segment_id);"
+        )
+        self._fts = self._create_fts()
+        self._db.commit()
+
+    def _create_fts(self) -> bool:
+        # external content table, the triggers keep it in sync with segment_texts
+        try:
+            self._db.executescript(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS segment_texts_fts USING fts5("
+                "text, content='segment_texts', content_rowid='id', tokenize='trigram');"
+                "CREATE TRIGGER IF NOT EXISTS segment_texts_ai AFTER INSERT ON segment_texts BEGIN "
+                "INSERT INTO segment_texts_fts(rowid, text) VALUES (new.id, new.text); END;"
+                "CREATE TRIGGER IF NOT EXISTS segment_texts_ad AFTER DELETE ON segment_texts BEGIN "
+                "INSERT INTO segment_texts_fts(segment_texts_fts, rowid, text) VALUES ('delete', old.id, old.text); END;"
+                "CREATE TRIGGER IF NOT EXISTS segment_texts_au AFTER UPDATE ON segment_texts BEGIN "
+                "INSERT INTO segment_texts_fts(segment_texts_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+                "INSERT INTO segment_texts_fts(rowid, text) VALUES (new.id, new.text); END;"
+            )
+            return True
+        except sqlite3.OperationalError as e:
+            # sqlite without fts5 / trigram (older than 3.34), search falls back to LIKE
+            print(f"Full text search unavailable: {e}")
+            return False
+
+    def add_meeting(self, meeting_id:str, source:str=None, duration:float=None):
+        # resuming a meeting keeps its creation time, duration is only updated when given
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO meetings VALUES (?, ?, ?, ?) ON CONFLICT(meeting_id) DO UPDATE SET "
+                "source=COALESCE(excluded.source, source), duration=COALESCE(excluded.duration, duration)",
+                (meeting_id, source, time.time(), duration)
+            )
+            self._db.commit()
+
+    def has_meeting(self, meeting_id:str) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM meetings WHERE meeting_id=?", (meeting_id,)).fetchone() is not None
+
+    def delete_meeting(self, meeting_id:str):
+        with self._lock:
+            self._db.execute("DELETE FROM meetings WHERE meeting_id=?", (meeting_id,))
+            self._db.commit()
+
+    # writing the same segment again replaces its text and keyword hits
+    # translations: target language -> text
+    def add_segment(self, meeting_id:str, segment_id:int, source_language:str, original_text:str,
+                    start_time:float=None, end_time:float=None, translations:Dict[str, str]=None,
+                    keyword_hits:Iterable[KeywordHit]=()):
+        with self._lock:
+            self._add_segment(meeting_id, segment_id, source_language, original_text, start_time, end_time, translations or {}, keyword_hits)
+            self._db.commit()
+
+    def _add_segment(self, meeting_id, segment_id, source_language, original_text, start_time, end_time, translations, keyword_hits):
+        self._db.execute(
+            "INSERT INTO segments VALUES (?, ?, ?, ?, ?) ON CONFLICT(meeting_id, segment_id) DO UPDATE SET "
+            "start_time=excluded.start_time, end_time=excluded.end_time, source_language=excluded.source_language",
+            (meeting_id, segment_id, start_time, end_time, source_language)
+        )
+        # the segment's texts are replaced as a whole, stale translations from an earlier version must not stay searchable
+        self._db.execute("DELETE FROM segment_texts WHERE meeting_id=? AND segment_id=?", (meeting_id, segment_id))
+        self._put_texts(meeting_id, segment_id, "original", {source_language: original_text})
+        self._put_texts(meeting_id, segment_id, "translation", translations)
+        self._db.execute("DELETE FROM keyword_hits WHERE meeting_id=? AND segment_id=?", (meeting_id, segment_id))
+        self._db.executemany(
+            "INSERT INTO keyword_hits VALUES (?, ?, ?, ?, ?, ?)",
+            [(meeting_id, segment_id, keyword_id, language, start, end) for keyword_id, language, start, end in keyword_hits]
+        )
+
+    def _put_texts(self, meeting_id:str, segment_id:int, kind:str, texts:Dict[str, str]):
+        # an upsert (not INSERT OR REPLACE) so the update trigger keeps the fts index in sync
+        self._db.executemany(
+            "INSERT INTO segment_texts (meeting_id, segment_id, kind, language, text) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(meeting_id, segment_id, kind, language) DO UPDATE SET text=excluded.text",
+            [(meeting_id, segment_id, kind, language, text) for language, text in texts.items()]
+        )
+
+    # translations: segment_id -> {target language -> text}, for segments already added
+    def add_translations(self, meeting_id:str, translations:Dict[int, Dict[str, str]]):
+        with self._lock:
+            for segment_id, texts in translations.items():
+                self._put_texts(meeting_id, segment_id, "translation", texts)
+            self._db.commit()
+
+    # one whole meeting in one transaction, segments are dicts in batch_transcribe's output format
+    def save_meeting(self, meeting_id:str, source:str, duration:float, segments:List[dict]):
+        with self._lock:
+            self._db.execute("DELETE FROM meetings WHERE meeting_id=?", (meeting_id,))
+            self._db.execute("INSERT INTO meetings VALUES (?, ?, ?, ?)", (meeting_id, source, time.time(), duration))
+            for segment in segments:
+                keyword_hits = [(hit["id"], hit["language"], hit["start"], hit["end"]) for hit in segment.get("keyword_positions", [])]
+                self._add_segment(meeting_id, segment["segment_id"], segment["source_language"], segment["original_text"],
+                                  segment.get("start_time"), segment.get("end_time"), segment.get("translations", {}), keyword_hits)
+            self._db.commit()
+
+    _SEGMENT_COLUMNS = "s.meeting_id, s.segment_id, s.start_time, s.end_time, s.source_language"
+
+    def segments_with_keyword(self, keyword_id:int, meeting_id:str=None, limit:int=100) -> List[dict]:
+        """returns every segment (across meetings unless meeting_id is given) where the keyword was detected,
+            with the original text and how many times it was hit
+        """
+        query = (
+            f"SELECT {self._SEGMENT_COLUMNS}, o.text AS original_text, COUNT(*) AS hits "
+            "FROM keyword_hits k "
+            "JOIN segments s ON s.meeting_id=k.meeting_id AND s.segment_id=k.segment_id "
+            "LEFT JOIN segment_texts o ON o.meeting_id=s.meeting_id AND o.segment_id=s.segment_id AND o.kind='original' "
+            "WHERE k.keyword_id=?"
+        )
+        params = [keyword_id]
+        if meeting_id is not None:
+            query += " AND k.meeting_id=?"
+            params.append(meeting_id)
+        query += " GROUP BY s.meeting_id, s.segment_id ORDER BY s.meeting_id, s.segment_id LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, params)]
+
+    def search(self, text:str, language:str=None, meeting_id:str=None, limit:int=50) -> List[dict]:
+        """full text search over original texts and translations
+            language: only texts in this language (original or translated)
+            returns the matching segments with the text that matched, best matches first
+        """
+        conditions = []
+        params = []
+        # trigram needs at least 3 characters, shorter queries use LIKE
+        if self._fts and len(text) >= 3:
+            source = "segment_texts_fts f JOIN segment_texts t ON t.id=f.rowid"
+            conditions.append("segment_texts_fts MATCH ?")
+            params.append('"' + text.replace('"', '""') + '"')
+            order = "f.rank"
+        else:
+            source = "segment_texts t"
+            conditions.append("t.text LIKE ? ESCAPE '\\'")
+            params.append("%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+            order = "t.meeting_id, t.segment_id"
+        if language is not None:
+            conditions.append("t.language=?")
+            params.append(language)
+        if meeting_id is not None:
+            conditions.append("t.meeting_id=?")
+            params.append(meeting_id)
+        query = (
+            f"SELECT {self._SEGMENT_COLUMNS}, t.kind, t.language, t.text FROM {source} "
+            "JOIN segments s ON s.meeting_id=t.meeting_id AND s.segment_id=t.segment_id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY {order} LIMIT ?"
+        )
+        params.append(limit)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(query, params)]
+
+    def keyword_counts(self, meeting_id:str=None) -> Dict[int, int]:
+        # keyword id -> hits, duplicates counted (TSMC requirement)
+        query = "SELECT keyword_id, COUNT(*) FROM keyword_hits"
+        params = []
+        if meeting_id is not None:
+            query += " WHERE meeting_id=?"
+            params.append(meeting_id)
+        query += " GROUP BY keyword_id"
+        with self._lock:
+            return {keyword_id: count for keyword_id, count in self._db.execute(query, params)}
+
+    def get_meeting(self, meeting_id:str) -> Optional[dict]:
+        """returns the meeting with its segments in order, each with "original_text" and "translations"
+        """
+        with self._lock:
+            meeting = self._db.execute("SELECT * FROM meetings WHERE meeting_id=?", (meeting_id,)).fetchone()
+            if meeting is None:
+                return None
+            segments = dict()
+            for row in self._db.execute(
+                    f"SELECT {self._SEGMENT_COLUMNS} FROM segments s WHERE s.meeting_id=? ORDER BY s.segment_id", (meeting_id,)):
+                segments[row["segment_id"]] = dict(row, original_text=None, translations=dict(), keywords=[])
+            for row in self._db.execute("SELECT segment_id, kind, language, text FROM segment_texts WHERE meeting_id=?", (meeting_id,)):
+                if row["kind"] == "original":
+                    segments[row["segment_id"]]["original_text"] = row["text"]
+                else:
+                    segments[row["segment_id"]]["translations"][row["language"]] = row["text"]
+            for row in self._db.execute("SELECT segment_id, keyword_id FROM keyword_hits WHERE meeting_id=? ORDER BY rowid", (meeting_id,)):
+                segments[row["segment_id"]]["keywords"].append(row["keyword_id"])
+        return dict(meeting, segments=list(segments.values()))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,58 @@
+from typing import List
+
+# websocket 訊息格式，前端依 version 決定如何解析
+# 每則訊息都有遞增的 seq（每個 session 各自計算），前端發現 seq 跳號時可以送 {"type": "resync"} 取得完整狀態
+# 前端收到定案片段後可以送 {"type": "ack", "segment_id"}，重新連線時只補送之後的片段
+# /ws/stream 會議結束時送 {"type": "end"}，最後一句也會定案，之後收到 complete 事件
+#   delta:  {"version", "type": "delta", "seq", "segments": [entry, ...]}  只包含新增或改變的片段
+#   resync: {"version", "type": "resync", "seq", "segments": [entry, ...]}  所有已定案的片段，前端直接取代目前的內容
+#   session: {"version", "type": "session", "seq", "session_id", "resumed", "ttl"}  /ws/stream 連線後的第一則訊息
+#   其他事件（keywords / complete / error）: {"version", "type", "seq", ...}
+# entry: {"segment_id", "language", "text", "final"}，final=False 表示之後還會被同一個 segment_id 的 entry 取代
+#   定案片段第一次送出時另外附上 "keywords": [{"id", "language", "start", "end"}]，original[start:end] 為關鍵字
+SCHEMA_VERSION = 1
+
+def segment_entry(segment_id:int, language:str, text:str, final:bool=True, **extra) -> dict:
+    entry = {
+        "segment_id": segment_id,
+        "language": language,
+        "text": text,
+        "final": final
+    }
+    entry.update(extra)
+    return entry
+
+def event_message(message_type:str, seq:int, **fields) -> dict:
+    message = {
+        "version": SCHEMA_VERSION,
+        "type": message_type,
+        "seq": seq
+    }
+    message.update(fields)
+    return message
+
+def delta_message(seq:int, entries:List[dict]) -> dict:
+    return event_message("delta", seq, segments=entries)
+
+def keyword_positions(matches) -> List[dict]:
+    """
+    pattern_finder.find_matches 的結果轉成 entry 的 keywords 欄位
+    """
+    return [{"id": match.id, "language": match.language, "start": match.start, "end": match.end} for match in matches]
+
+def session_entries(session, after_segment_id:int=-1) -> List[dict]:
+    """
+    session 中 segment_id > after_segment_id 的所有已定案片段（原文資訊 + 每個語言的翻譯）
+    """
+    entries = []
+    for language, translations in session.translations.items():
+        for segment_id in range(max(after_segment_id, -1) + 1, len(translations)):
+            entries.append(segment_entry(
+                segment_id, language, translations[segment_id],
+                original=session.original[segment_id],
+                source_language=session.source_languages[segment_id]
+            ))
+    return entries
+
+def resync_message(seq:int, session) -> dict:
+    return event_message("resync", seq, segments=session_entries(session))
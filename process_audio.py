@@ -1,224 +1,311 @@
 import webrtcvad
 import wave
 import os
+import numpy as np
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 import noisereduce as nr
-import soundfile as sf
-from function import merge_audio_files
 
-def process_audio_file(input_path, output_dir_path):
-    # 先進行降噪處理
-    audio, sample_rate = sf.read(input_path)
-    reduced_noise = nr.reduce_noise(y=audio, sr=sample_rate, prop_decrease=0.9)  # 增加降噪強度
-    sf.write("reduced_noise.wav", reduced_noise, sample_rate)
+class Segment(NamedTuple):
+    start: int  # 在整段音訊中的起始位置 (bytes)
+    end: int    # 在整段音訊中的結束位置 (bytes)
+    pcm: bytes  # 16kHz, 16-bit, 單聲道 PCM
+
+def read_pcm(audio):
+    """
+    取得 16kHz, 16-bit, 單聲道 PCM；audio 可以是 PCM (bytes / memoryview) 或 wav 檔路徑
+    PCM 直接以 memoryview 回傳，不複製
+    """
+    if not isinstance(audio, str):
+        return memoryview(audio).cast('B')
+    with wave.open(audio, 'rb') as wav_file:
+        if(wav_file.getnchannels() != 1 or wav_file.getsampwidth() != 2 or wav_file.getframerate() != 16000):
+            raise ValueError("Invalid WAV file format")
+        return wav_file.readframes(wav_file.getnframes())
+
+def write_segments(segments, output_dir_path):
+    for i, segment in enumerate(segments):
+        output_file = os.path.join(output_dir_path, f"segment_{i + 1}.wav")
+        with wave.open(output_file, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(16000)
+            f.writeframes(segment.pcm)
+
+def speech_flags(vad, pcm, sample_rate=16000, frame_duration_ms=20) -> np.ndarray:
+    """
+    對每一個完整的幀做 VAD，回傳 bool 陣列
+    PCM 以 NumPy int16 陣列檢視，每一幀都是 memoryview，不會複製音訊
+    """
+    samples_per_frame = int(sample_rate * frame_duration_ms // 1000)
+    samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+    frame_count = len(samples) // samples_per_frame
+    frames = samples[:frame_count * samples_per_frame].reshape(frame_count, samples_per_frame)
+    flags = np.empty(frame_count, dtype=bool)
+    for i in range(frame_count):
+        # webrtcvad 以 item 數當長度，必須轉成 byte 格式的 memoryview
+        flags[i] = vad.is_speech(frames[i].data.cast('B'), sample_rate)
+    return flags
+
+def find_segments(flags, threshold, frame_size, total_length) -> List[Tuple[int, int]]:
+    """
+    由每一幀的 VAD 結果找出斷句位置 (start_byte, end_byte)
+    連續超過 threshold 幀有聲音才算開始說話，開始後連續 threshold 幀沒聲音就斷句。
+    以 run-length 一次處理一整段相同的幀，結果與逐幀計數相同。
+    """
+    if len(flags) == 0:
+        return []
+    run_starts = np.concatenate(([0], np.flatnonzero(np.diff(flags.astype(np.int8))) + 1))
+    run_lengths = np.diff(np.concatenate((run_starts, [len(flags)])))
+    run_values = flags[run_starts]
+    
+    vad_segments = []
+    last_cut = 0
+    start = False
+    for run_start, run_length, is_speech in zip(run_starts.tolist(), run_lengths.tolist(), run_values.tolist()):
+        if is_speech:
+            if not start and run_length > threshold:
+                start = True
+        elif start and run_length >= threshold:
+            # 第 threshold 個無聲的幀就是斷點
+            cut = (run_start + threshold - 1) * frame_size
+            vad_segments.append((last_cut, cut))
+            last_cut = cut
+            start = False
+    
+    if start:
+        vad_segments.append((last_cut, total_length))
+    return vad_segments
+
+class NoiseReducer:
+    """
+    分段串流降噪：雜訊特徵只在第一個區塊估計一次，之後每個區塊重複使用。
+    每個區塊前後各多取 overlap 長度的音訊一起處理再丟掉，避免區塊邊界出現雜音。
+    記憶體只需要一個區塊的大小，不用等整個檔案降噪完才能開始斷句。
+    與舊的整檔 non-stationary 降噪相比，句間的停頓比較不容易被 VAD 判成靜音，斷出來的句子較少、較長
+    （voice_output_reduced.wav：16 段、最長 12.3 秒 -> 11 段、最長 30.8 秒）
+    """
+    def __init__(self, sample_rate=16000, block_seconds=10, overlap_seconds=0.5, noise_seconds=0.5, prop_decrease=0.9):
+        self.sample_rate = sample_rate
+        self.prop_decrease = prop_decrease
+        self.block_size = int(block_seconds * sample_rate) # samples
+        self.overlap_size = int(overlap_seconds * sample_rate)
+        self.noise_size = int(noise_seconds * sample_rate)
+        self._pending = np.zeros(0, dtype=np.float32) # 還沒降噪的樣本
+        self._context = np.zeros(0, dtype=np.float32) # 上一個區塊的尾端
+        self._noise_clip = None
+    
+    def feed(self, pcm_bytes) -> bytes:
+        """
+        加入 16-bit PCM，回傳已經降噪完成的 16-bit PCM（可能為空）
+        """
+        samples = np.frombuffer(pcm_bytes, dtype=np.int16, count=len(pcm_bytes) // 2).astype(np.float32) / 32768
+        self._pending = np.concatenate((self._pending, samples))
+        output = []
+        # 需要多等 overlap 長度的音訊，區塊結尾才有後文可以參考
+        while len(self._pending) >= self.block_size + self.overlap_size:
+            block = self._pending[:self.block_size]
+            lookahead = self._pending[self.block_size:self.block_size + self.overlap_size]
+            output.append(self._process(block, lookahead))
+            self._context = block[-self.overlap_size:] if self.overlap_size else self._context
+            self._pending = self._pending[self.block_size:]
+        return b"".join(output)
+    
+    def flush(self) -> bytes:
+        """
+        輸入結束時呼叫，處理剩下的音訊
+        """
+        if len(self._pending) == 0:
+            return b""
+        output = self._process(self._pending, self._pending[:0])
+        self._pending = np.zeros(0, dtype=np.float32)
+        return output
+    
+    def _process(self, block, lookahead) -> bytes:
+        if self._noise_clip is None:
+            self._noise_clip = self._estimate_noise(np.concatenate((block, lookahead)))
+        window = np.concatenate((self._context, block, lookahead))
+        if len(window) < 4096: # 太短無法做 STFT，直接輸出
+            reduced = block
+        else:
+            reduced = nr.reduce_noise(y=window, sr=self.sample_rate, y_noise=self._noise_clip,
+                                      stationary=True, prop_decrease=self.prop_decrease)
+            reduced = reduced[len(self._context):len(self._context) + len(block)]
+        return (np.clip(reduced, -1, 1) * 32767).astype(np.int16).tobytes()
+    
+    def _estimate_noise(self, samples) -> np.ndarray:
+        # 取能量最低的幾個 20ms 幀當作雜音樣本
+        frame_length = self.sample_rate // 50
+        frame_count = len(samples) // frame_length
+        if frame_count == 0:
+            return samples
+        frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length)
+        energy = np.square(frames).mean(axis=1)
+        quietest = np.sort(np.argsort(energy)[:max(1, self.noise_size // frame_length)])
+        return frames[quietest].reshape(-1)
+
+def process_audio_file(audio, output_dir_path=None) -> List[Segment]:
+    """
+    降噪後以 VAD 斷句
+    Args:
+        audio: 16kHz, 16-bit, 單聲道 PCM 或 wav 檔路徑
+        output_dir_path: 若有指定，另外把每一段存成 segment_N.wav
+    Returns:
+        List[Segment]: 每一段的位置與 PCM
+    """
+    sample_rate = 16000
+    
+    # 先進行降噪處理（分區塊處理，不需要一次把整個檔案轉成 float）
+    noise_reducer = NoiseReducer(sample_rate, prop_decrease=0.9)  # 增加降噪強度
+    pcm = memoryview(read_pcm(audio))
+    block_size = noise_reducer.block_size * 2
+    frames = b"".join(noise_reducer.feed(pcm[i:i + block_size]) for i in range(0, len(pcm), block_size)) + noise_reducer.flush()
     
     vad = webrtcvad.Vad()
     vad.set_mode(1)  # 調整模式以適應您的音頻環境
     
-    with wave.open("reduced_noise.wav", 'rb') as wav_file:
-        if(wav_file.getnchannels() != 1 or wav_file.getsampwidth() != 2 or wav_file.getframerate() != 16000):
-            raise ValueError("Invalid WAV file format")
-        
-        sample_rate = wav_file.getframerate()
-        frames = wav_file.readframes(wav_file.getnframes())
-        
-        frame_duration_ms = 20  # 調整幀持續時間
-        bytes_per_sample = 2
-        samples_per_frame = int(sample_rate * frame_duration_ms // 1000)
-        frame_size = samples_per_frame * bytes_per_sample
-        
-        start_byte = 0
-        vad_segments = []
-        active_count = 0
-        inactive_count = 0
-        last_cut = 0
-        start = False
-        
-        while start_byte + frame_size < len(frames):
-            end_byte = min(start_byte + frame_size, len(frames))
-            frame_bytes = frames[start_byte:end_byte]
-            
-            if not vad.is_speech(frame_bytes, sample_rate):
-                inactive_count += 1
-                active_count = 0
-            else:
-                inactive_count = 0
-                if not start and active_count < 20:
-                    active_count += 1
-                else:
-                    start = True
+    frame_duration_ms = 20  # 調整幀持續時間
+    bytes_per_sample = 2
+    samples_per_frame = int(sample_rate * frame_duration_ms // 1000)
+    frame_size = samples_per_frame * bytes_per_sample
+    
+    # 最後一個完整的幀不做 VAD（與原本逐幀的迴圈相同）
+    frame_count = max(0, (len(frames) - 1) // frame_size)
+    flags = speech_flags(vad, memoryview(frames)[:frame_count * frame_size], sample_rate, frame_duration_ms)
+    vad_segments = find_segments(flags, 20, frame_size, len(frames))
+    
+    segments = [Segment(seg[0], seg[1], frames[seg[0]:seg[1]]) for seg in vad_segments]
+    if output_dir_path is not None:
+        write_segments(segments, output_dir_path)
+    return segments
 
-            if inactive_count == 20 and start:
-                vad_segments.append((last_cut, start_byte))
-                last_cut = start_byte
-                start = False
-                active_count = 0
-            
-            start_byte += frame_size
+class AudioStream:
+    """
+    串流斷句器：跨呼叫保留 VAD 計數與尚未定案的音訊，每次只檢查新進來的幀。
+    buffer 只保存目前這句話（以及句首前一小段靜音），所以每個 chunk 的處理時間
+    與會議長度無關。
+    """
+    def __init__(self, sample_rate=16000, vad_mode=1, threshold=25, preroll_frames=50, max_segment_seconds=30):
+        self.vad = webrtcvad.Vad()
+        self.vad.set_mode(vad_mode) # 0 ~ 3
+        self.sample_rate = sample_rate
         
-        if start:
-            vad_segments.append((last_cut, len(frames)))
+        frame_duration_ms = 20 # 20ms
+        bytes_per_sample = 2 # 2 bytes
+        samples_per_frame = int(sample_rate * frame_duration_ms // 1000) # 16000 * 20 / 1000 = 320
+        self.frame_size = samples_per_frame * bytes_per_sample # 320 * 2 = 640
         
-        for i, seg in enumerate(vad_segments):
-            segment = frames[seg[0]:seg[1]]
-            output_file = os.path.join(output_dir_path, f"segment_{i + 1}.wav")
-            with wave.open(output_file, 'wb') as f:
-                f.setnchannels(1)
-                f.setsampwidth(2)
-                f.setframerate(16000)
-                f.writeframes(segment)
+        self.threshold = threshold # 連續幾幀有聲音才算開始說話 / 連續幾幀沒聲音才算斷句
+        self.preroll_size = preroll_frames * self.frame_size # 尚未開始說話時最多保留的音訊
+        # None：不強制斷句（整個檔案處理時不需要限制 buffer 大小）
+        self.max_segment_size = None if max_segment_seconds is None else int(max_segment_seconds * sample_rate) * bytes_per_sample
         
-        return vad_segments
-
-class AudioStream:
-    def __init__(self):
         self.active_count = 0
         self.inactive_count = 0
         self.start = False
-        self.left_bytes = bytearray()
+        self.buffer = bytearray() # 尚未定案的音訊
+        self.scanned = 0 # buffer 中已經做過 VAD 的 bytes
+        self.offset = 0 # buffer[0] 在整段串流中的位置
         self.sentence_count = 0
-        self.buffer = bytearray()
-        self.last_cut = 0
-        
-    def streaming_sentence_detector(self, frame_bytes, sample_rate, output_dir_path):
-        vad = webrtcvad.Vad()
-        vad.set_mode(2) # 0 ~ 3
-        
-        frame_duration_ms = 20 # 20ms
-        bytes_per_sample = 2 # 2 bytes
-        samples_per_frame = int(sample_rate * frame_duration_ms // 1000) # 16000 * 20 / 1000 = 320
-        frame_size = samples_per_frame * bytes_per_sample # 320 * 2 = 640
-        
-        start_byte = 0
-        have_sentence_end = False
         
-        # 將上次剩餘的bytes與新的frame_bytes合併
-        self.buffer.extend(frame_bytes)
+    def feed(self, pcm_bytes) -> List[Segment]:
+        """
+        加入新解碼的 PCM，回傳這次定案的句子
+        """
+        self.buffer.extend(pcm_bytes)
+        segments = []
+        frame_size = self.frame_size
         
-        total_length = len(self.buffer)
-        start_byte = self.last_cut
+        # 新進來的幀一次做完 VAD
+        new_frames = (len(self.buffer) - self.scanned) // frame_size
+        flags = speech_flags(self.vad, bytes(self.buffer[self.scanned:self.scanned + new_frames * frame_size]), self.sample_rate)
         
-        while start_byte + frame_size <= total_length:
-            current_frame = self.buffer[start_byte:start_byte + frame_size]
-            
-            if not vad.is_speech(current_frame, sample_rate):
-                # print("not speaking")
+        for is_speech in flags.tolist():
+            if not is_speech:
                 self.inactive_count += 1
                 self.active_count = 0
             else:
-                # print("speaking")
                 self.inactive_count = 0
-                if not self.start and self.active_count < 25:
+                if not self.start and self.active_count < self.threshold:
                     self.active_count += 1
                 else:
-                    self.start = True 
+                    self.start = True
             
-            if self.inactive_count == 25 and self.start:
-                # print("sentence end")
-                
-                segment_data = self.buffer[self.last_cut:start_byte]
-                if segment_data:
-                    self.sentence_count += 1
-                    output_file = f"{output_dir_path}/sentence_{self.sentence_count}.wav"
-                    with wave.open(output_file, 'wb') as f:
-                        f.setnchannels(1)
-                        f.setsampwidth(2)
-                        f.setframerate(16000)
-                        f.writeframes(segment_data)
+            if self.inactive_count == self.threshold and self.start:
+                segments.append(self._cut(self.scanned))
+            elif self.start and self.max_segment_size is not None and self.scanned + frame_size >= self.max_segment_size:
+                # 句子太長，強制斷句避免 buffer 無限制成長
+                segments.append(self._cut(self.scanned + frame_size))
+                continue
                 
-                self.start = False
-                self.inactive_count = 0
-                self.active_count = 0
-                self.last_cut = start_byte + frame_size
-                have_sentence_end = True
-                
-            start_byte += frame_size
-        
-        if self.last_cut > 0:
-            self.buffer = self.buffer[self.last_cut:]
-            self.last_cut = 0
-        return have_sentence_end
-    
-class AudioStream2:
-    def __init__(self):
-        self.count = 1
-        
-    def streaming_sentence_detector(self, input_path, output_dir_path):
-        vad = webrtcvad.Vad()
-        vad.set_mode(1) # 0 ~ 3
-        
-        with wave.open(input_path, 'rb') as wav_file:
-            
-            if(wav_file.getnchannels() != 1 or wav_file.getsampwidth() != 2 or wav_file.getframerate() != 16000):
-                raise ValueError("Invalid WAV file format")
-            
-            sample_rate = wav_file.getframerate() # 16000
-            frames = wav_file.readframes(wav_file.getnframes()) # 16000 * 2 * 20
-            
-            frame_duration_ms = 20 # 20ms
-            bytes_per_sample = 2 # 2 bytes
-            samples_per_frame = int(sample_rate * frame_duration_ms // 1000) # 16000 * 20 / 1000 = 320
-            frame_size = samples_per_frame * bytes_per_sample # 320 * 2 = 640
-            
-            start_byte = 0
-            vad_segments = []
-            active_count = 0
-            inactive_count = 0
-            last_cut = 0
-            start = False
-            
-            # 每20ms進行一次VAD(Voice Activity Detection)
-            while start_byte + frame_size < len(frames):
-                end_byte = min(start_byte + frame_size, len(frames))
-                frame_bytes = frames[start_byte:end_byte] # 獲得這30ms的音檔
-                
-                # 若空白音檔持續至少約300ms，則紀錄起來
-                if not vad.is_speech(frame_bytes, sample_rate):
-                    # print("not speaking")
-                    inactive_count += 1
-                    active_count = 0
-                else:
-                    # print("speaking")
-                    inactive_count = 0
-                    if not start and active_count < 25:
-                        active_count += 1
-                    else:
-                        start = True
+            self.scanned += frame_size
+            # 還沒開始說話時只保留最後一小段，讓句首不會被切掉
+            # 每一幀都檢查，句子的起點才不會受 chunk 大小影響
+            if not self.start and self.scanned > self.preroll_size:
+                self._drop(self.scanned - self.preroll_size)
+        return segments
+    
+    def pending(self) -> Optional[Segment]:
+        """
+        回傳目前還在說的句子（尚未定案），沒有則回傳 None
+        """
+        if not self.start:
+            return None
+        return Segment(self.offset, self.offset + self.scanned, bytes(self.buffer[:self.scanned]))
+    
+    def flush(self) -> List[Segment]:
+        """
+        串流結束時呼叫，把還沒斷句的最後一句送出
+        """
+        segments = []
+        if self.start:
+            segments.append(self._cut(len(self.buffer)))
+        self._drop(len(self.buffer))
+        self.inactive_count = 0
+        return segments
+    
+    def _cut(self, end) -> Segment:
+        segment = Segment(self.offset, self.offset + end, bytes(self.buffer[:end]))
+        self._drop(end)
+        self.sentence_count += 1
+        self.start = False
+        self.active_count = 0
+        return segment
+    
+    def _drop(self, size):
+        del self.buffer[:size]
+        self.scanned = max(0, self.scanned - size)
+        self.offset += size
+    
+class SegmentPipeline:
+    """
+    降噪 → VAD 斷句 的串流管線，每次加入一段 PCM 就回傳已經定案的句子
+    max_segment_seconds: 句子超過這個長度就強制斷句，None 表示不限制
+    """
+    def __init__(self, sample_rate=16000, threshold=20, max_segment_seconds=30):
+        self.noise_reducer = NoiseReducer(sample_rate)
+        self.audio_stream = AudioStream(sample_rate, vad_mode=1, threshold=threshold, max_segment_seconds=max_segment_seconds)
+    
+    def feed(self, pcm_bytes) -> List[Segment]:
+        return self.audio_stream.feed(self.noise_reducer.feed(pcm_bytes))
+    
+    def flush(self) -> List[Segment]:
+        segments = self.audio_stream.feed(self.noise_reducer.flush())
+        return segments + self.audio_stream.flush()
+
+def iter_audio_segments(audio, block_seconds=10) -> Iterator[Segment]:
+    """
+    與 process_audio_file 相同的降噪與斷句，但每處理完一個區塊就交出已經定案的句子，
+    後面的音訊還在降噪時，前面的句子就可以先開始轉錄
+    跟 process_audio_file 一樣不強制切斷長句（整個檔案已經在記憶體中，不需要限制 buffer），
+    所以片段可能超過 /ws/stream 的 30 秒上限（見 NoiseReducer），STT 後端都能處理超過 30 秒的片段
+    """
+    pcm = memoryview(read_pcm(audio))
+    pipeline = SegmentPipeline(max_segment_seconds=None)
+    block_size = int(block_seconds * 16000) * 2
+    for start in range(0, len(pcm), block_size):
+        yield from pipeline.feed(pcm[start:start + block_size])
+    yield from pipeline.flush()
 
-                if inactive_count == 25 and start:
-                    vad_segments.append((last_cut, start_byte))
-                    last_cut = start_byte
-                    start = False
-                    active_count = 0
-                
-                # 下一段音檔
-                start_byte += frame_size
-            
-            output_file = os.path.join(output_dir_path, f"segment.wav")
-            if os.path.exists(output_file):
-                os.remove(output_file)
-            
-            # 若最後一段音檔是空白音檔，則不加入
-            if start:
-                segment = frames[last_cut:len(frames)]
-                with wave.open(output_file, 'wb') as f:
-                    f.setnchannels(1)
-                    f.setsampwidth(2)
-                    f.setframerate(16000)
-                    f.writeframes(segment)
-                return True
-            
-            elif not os.path.exists(output_file) and len(vad_segments) > 0:
-                segment = frames[vad_segments[-1][0]:vad_segments[-1][1]]
-                with wave.open(output_file, 'wb') as f:
-                    f.setnchannels(1)
-                    f.setsampwidth(2)
-                    f.setframerate(16000)
-                    f.writeframes(segment)
-                
-                self.count += 1
-                return True
-                
-                
 # input_path = "./voice_output.wav"
 # output_dir_path = "./output_segments"
 # segments = process_audio_file(input_path, output_dir_path)
@@ -0,0 +1,181 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+SESSION_ROOT = "./sessions"
+SESSION_TTL = 300 # 秒，斷線後 session 保留多久，期間內可以用 session_id 重新連線
+# 秒，session 結束後目錄（transcript.jsonl 等輸出檔）保留多久，None 表示永久保留
+# 片段、翻譯與關鍵字都已經存進 meeting_store，這些檔案只是方便直接取用的副本
+SESSION_RETENTION = 7 * 24 * 3600
+
+class MeetingSession:
+    """
+    一個 websocket 連線（一場會議）的所有狀態。
+    中間檔案都放在自己的目錄底下，轉錄結果與關鍵字也只存在這個物件中，
+    所以同一個 worker 可以同時處理多場會議而不會互相覆蓋。
+    """
+    def __init__(self, session_id:str=None, root_dir:str=SESSION_ROOT):
+        self.id = session_id or uuid.uuid4().hex
+        self.created_at = time.time()
+        self.scratch_dir = os.path.join(root_dir, self.id) # 會議的輸出檔（transcript.jsonl 等）也在這裡，保留期限見 SESSION_RETENTION
+        os.makedirs(self.scratch_dir, exist_ok=True)
+
+        self.original: List[str] = [] # 每段的原文
+        self.source_languages: List[str] = [] # 每段偵測到的語言
+        self.translations: Dict[str, List[str]] = dict() # translations[language][segment_index]
+        self.keyword_hits: List[int] = [] # TSMC requirement: don't remove duplicates
+        self.seq = 0 # 送給前端的最後一則訊息編號
+        self.acked_segment_id = -1 # 前端確認收到的最後一個已定案片段
+        self.audio_stream = None # /ws/stream 還沒定案的音訊狀態，重新連線後接著使用
+        self.pending_segments = [] # 斷線時才斷出來、還沒轉錄的片段，重新連線或過期時處理
+
+    def add_segment(self, text:str, source_language:str) -> int:
+        self.original.append(text)
+        self.source_languages.append(source_language)
+        return len(self.original) - 1
+
+    def add_translation(self, language:str, text:str):
+        self.translations.setdefault(language, []).append(text)
+
+    def add_keywords(self, keyword_nums:List[int]):
+        self.keyword_hits.extend(keyword_nums)
+
+    def detected_keywords(self) -> set:
+        return set(self.keyword_hits)
+
+    def next_seq(self) -> int:
+        """
+        下一則 websocket 訊息的編號
+        """
+        self.seq += 1
+        return self.seq
+
+
+class SessionRegistry:
+    """
+    記錄目前所有進行中的 session
+    所有連線都斷開後 session 會再保留 ttl 秒，這段時間內可以 resume
+    on_expire: session 過期被移除時呼叫（在 create / resume 的呼叫端執行，不在 lock 中）
+    retention: 已結束的 session 目錄超過幾秒沒有更新就由 remove_stale_directories 刪除，None 表示不刪除
+    """
+    def __init__(self, root_dir:str=SESSION_ROOT, ttl:float=SESSION_TTL, on_expire:Callable[[MeetingSession], None]=None,
+                 retention:Optional[float]=SESSION_RETENTION):
+        self._root_dir = root_dir
+        self.ttl = ttl
+        self.retention = retention
+        self._on_expire = on_expire
+        self._sessions: Dict[str, MeetingSession] = dict()
+        self._connections: Dict[str, int] = dict() # session_id -> 目前連著的 websocket 數量
+        self._expire_at: Dict[str, float] = dict() # 已斷線的 session_id -> 過期時間
+        self._lock = threading.Lock()
+
+    def create(self) -> MeetingSession:
+        session = MeetingSession(root_dir=self._root_dir)
+        with self._lock:
+            expired = self._purge_expired()
+            self._sessions[session.id] = session
+            self._connections[session.id] = 1
+        self._notify_expired(expired)
+        return session
+
+    def resume(self, session_id:str) -> Optional[MeetingSession]:
+        """
+        重新連線：回傳還沒過期的 session，已過期、不存在或還有其他連線連著則回傳 None
+        （兩個連線同時寫同一個 session 的斷句狀態與輸出檔會互相干擾）
+        """
+        with self._lock:
+            expired = self._purge_expired()
+            session = self._sessions.get(session_id)
+            if session is not None and self._connections.get(session_id, 0) > 0:
+                session = None
+            elif session is not None:
+                self._connections[session_id] = self._connections.get(session_id, 0) + 1
+                self._expire_at.pop(session_id, None)
+        self._notify_expired(expired)
+        return session
+
+    def detach(self, session_id:str):
+        """
+        連線中斷但保留 session，最後一個連線斷開後開始計算 ttl
+        """
+        with self._lock:
+            if session_id not in self._sessions:
+                return
+            self._connections[session_id] = self._connections.get(session_id, 1) - 1
+            if self._connections[session_id] <= 0:
+                self._expire_at[session_id] = time.time() + self.ttl
+
+    def get(self, session_id:str) -> Optional[MeetingSession]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def close(self, session_id:str) -> Optional[MeetingSession]:
+        with self._lock:
+            self._connections.pop(session_id, None)
+            self._expire_at.pop(session_id, None)
+            return self._sessions.pop(session_id, None)
+
+    def purge_expired(self):
+        """
+        移除已過期的 session 並呼叫 on_expire
+        create / resume 時也會檢查，但伺服器沒有新連線時要靠定期呼叫這個，斷線的 session 才會過期
+        """
+        with self._lock:
+            expired = self._purge_expired()
+        self._notify_expired(expired)
+
+    def remove_stale_directories(self) -> int:
+        """
+        刪除 root_dir 底下已結束、超過 retention 秒沒有更新的 session 目錄（會做檔案 I/O，不要在 event loop 中直接呼叫）
+        Returns:
+            刪除的目錄數量
+        """
+        if self.retention is None or not os.path.isdir(self._root_dir):
+            return 0
+        deadline = time.time() - self.retention
+        with self._lock:
+            active = set(self._sessions)
+        removed = 0
+        with os.scandir(self._root_dir) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.name in active:
+                    continue
+                if _last_modified(entry.path) < deadline:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+        return removed
+
+    def _purge_expired(self) -> List[MeetingSession]:
+        now = time.time()
+        expired = []
+        for session_id, expire_time in list(self._expire_at.items()):
+            if expire_time <= now:
+                del self._expire_at[session_id]
+                self._connections.pop(session_id, None)
+                session = self._sessions.pop(session_id, None)
+                if session is not None:
+                    expired.append(session)
+        return expired
+
+    def _notify_expired(self, expired:List[MeetingSession]):
+        if self._on_expire is None:
+            return
+        for session in expired:
+            self._on_expire(session)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+def _last_modified(directory:str) -> float:
+    """
+    目錄與其中檔案最後的修改時間（輸出檔是用追加的，目錄本身的 mtime 不會更新）
+    """
+    latest = os.stat(directory).st_mtime
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            latest = max(latest, entry.stat().st_mtime)
+    return latest
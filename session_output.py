@@ -0,0 +1,108 @@
+import asyncio
+import json
+import os
+from typing import Dict, Iterable, List
+
+TRANSCRIPT_FILE = "transcript.jsonl"
+TRANSLATION_FILE = "chinese_translation.txt"
+SEGMENT_KEYWORDS_FILE = "KEYWORDS_2.txt"
+KEYWORDS_FILE = "keywords.txt"
+
+class SessionOutput:
+    """
+    一個連線寫到 session 目錄的輸出檔。
+    handler 只把內容放進記憶體中的 buffer，背景的 writer task 在 thread 中批次寫入，
+    每個檔案每批只開一次，不會在 event loop 中逐行開檔。
+    片段定案時會觸發寫入（寫入中累積的內容在下一批一起寫），close() 時寫完所有內容。
+    檔案：
+        transcript.jsonl         每個定案片段一行，格式同 data.json 並加上時間與關鍵字：
+                                 {"segment_id", "start_time", "end_time", "source_language", "original_text", "translation", "keywords"}
+        chinese_translation.txt  每段的中文翻譯
+        KEYWORDS_2.txt           每段偵測到的關鍵字（原文語言）
+        keywords.txt             整場會議的關鍵字
+    """
+    def __init__(self, directory:str):
+        self._directory = directory
+        self._buffers: Dict[str, List[str]] = dict() # 檔名 -> 還沒寫入的行
+        self._waiters: List[asyncio.Future] = [] # flush() 等待中的 Future
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    def write_lines(self, filename:str, lines:Iterable[str]):
+        self._buffers.setdefault(filename, []).extend(lines)
+
+    def write_segment(self, segment_id:int, source_language:str, original_text:str, translation:str,
+                      keyword_nums:List[int], keyword_names:List[str], start_time:float=None, end_time:float=None):
+        """
+        一個定案的片段，寫入 transcript.jsonl / chinese_translation.txt / KEYWORDS_2.txt
+        Args:
+            keyword_nums: 片段中的關鍵字編號（重複出現會重複列出）
+            keyword_names: 關鍵字本身，寫到 KEYWORDS_2.txt
+            start_time, end_time: 片段在錄音中的時間（秒）
+        """
+        record = {
+            "segment_id": segment_id,
+            "start_time": start_time,
+            "end_time": end_time,
+            "source_language": source_language,
+            "original_text": original_text,
+            "translation": translation,
+            "keywords": keyword_nums
+        }
+        self.write_lines(TRANSCRIPT_FILE, [json.dumps(record, ensure_ascii=False)])
+        self.write_lines(TRANSLATION_FILE, [translation])
+        self.write_lines(SEGMENT_KEYWORDS_FILE, keyword_names)
+        self._wakeup.set()
+
+    def write_keywords(self, keyword_names:Iterable[str]):
+        """
+        整場會議偵測到的關鍵字，寫到 keywords.txt
+        """
+        self.write_lines(KEYWORDS_FILE, keyword_names)
+        self._wakeup.set()
+
+    async def flush(self):
+        """
+        等到目前 buffer 中的內容都寫入檔案
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._wakeup.set()
+        await waiter
+
+    async def close(self):
+        """
+        寫完剩下的內容並結束 writer task
+        """
+        if self._closed:
+            return
+        self._closed = True
+        await self.flush()
+        await self._task
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            buffers, self._buffers = self._buffers, dict()
+            waiters, self._waiters = self._waiters, []
+            if buffers:
+                try:
+                    await asyncio.to_thread(self._write, buffers)
+                except Exception as e:
+                    # 寫檔失敗不影響轉錄，這一批就放棄
+                    print(f"儲存文件時發生錯誤：{str(e)}")
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            if self._closed and not self._buffers and not self._waiters:
+                return
+
+    def _write(self, buffers:Dict[str, List[str]]):
+        for filename, lines in buffers.items():
+            if not lines:
+                continue
+            # 使用 'a' 模式來追加內容而不是覆蓋
+            with open(os.path.join(self._directory, filename), "a", encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n")
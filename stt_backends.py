@@ -0,0 +1,193 @@
+import abc
+import bisect
+import threading
+from typing import List, NamedTuple, Optional, Sequence
+import numpy as np
+from openai import OpenAI, AsyncOpenAI
+from function import to_wav_buffer
+from http_pool import run_blocking
+
+# the local engine is optional, only needed when local_whisper_backend is used
+try:
+    from faster_whisper import WhisperModel, BatchedInferencePipeline
+except ImportError:
+    WhisperModel = None
+    BatchedInferencePipeline = None
+
+SAMPLE_RATE = 16000
+MAX_CLIP_SECONDS = 30 # whisper decodes at most 30 seconds per window
+
+# whisper reports the language by name (API) or ISO code (local engine) -> Stt.LANGUAGES value
+WHISPER_LANGUAGES = {
+    "english": "en", "en": "en",
+    "chinese": "tw", "zh": "tw",
+    "japanese": "ja", "ja": "ja",
+    "german": "de", "de": "de"
+}
+
+class TranscriptSegment(NamedTuple):
+    start: float # seconds, from the start of the transcribed audio
+    end: float
+    text: str
+
+class TranscriptResult(NamedTuple):
+    text: str
+    language: Optional[str] # Stt.LANGUAGES value, None if whisper didn't report one of ours
+    segments: List[TranscriptSegment]
+    duration: Optional[float] # seconds
+
+def _to_language(name:Optional[str]) -> Optional[str]:
+    return WHISPER_LANGUAGES.get((name or "").lower())
+
+# speech-to-text engine used by Stt.STT
+# audio is 16kHz mono 16-bit PCM (bytes / memoryview) or an audio file object
+class stt_backend(abc.ABC):
+    batch_size = 1 # how many segments transcribe_batch handles efficiently at once
+
+    @abc.abstractmethod
+    def transcribe(self, audio, prompt:str=None) -> TranscriptResult:
+        raise NotImplementedError
+
+    def transcribe_batch(self, audios:Sequence, prompt:str=None) -> List[TranscriptResult]:
+        return [self.transcribe(audio, prompt) for audio in audios]
+
+    async def atranscribe(self, audio, prompt:str=None) -> TranscriptResult:
+        return await run_blocking(self.transcribe, audio, prompt)
+
+# OpenAI Whisper API, one request per segment
+# verbose_json also returns the detected language, timestamps and duration
+class openai_backend(stt_backend):
+
+    # async_client: optional AsyncOpenAI client used by atranscribe
+    def __init__(self, client:OpenAI, async_client:AsyncOpenAI=None, model:str="whisper-1"):
+        self.client = client
+        self.async_client = async_client
+        self.model = model
+
+    def transcribe(self, audio, prompt:str=None) -> TranscriptResult:
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            audio = to_wav_buffer(audio)
+        result = self.client.audio.transcriptions.create(
+            model=self.model,
+            file=audio,
+            prompt=prompt,
+            response_format="verbose_json"
+        )
+        return self._to_result(result)
+
+    async def atranscribe(self, audio, prompt:str=None) -> TranscriptResult:
+        if self.async_client is None:
+            return await super().atranscribe(audio, prompt)
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            audio = to_wav_buffer(audio)
+        result = await self.async_client.audio.transcriptions.create(
+            model=self.model,
+            file=audio,
+            prompt=prompt,
+            response_format="verbose_json"
+        )
+        return self._to_result(result)
+
+    @staticmethod
+    def _to_result(result) -> TranscriptResult:
+        segments = [TranscriptSegment(segment.start, segment.end, segment.text) for segment in (getattr(result, "segments", None) or [])]
+        return TranscriptResult(result.text, _to_language(getattr(result, "language", None)), segments, getattr(result, "duration", None))
+
+# in-process quantized Whisper (faster-whisper / CTranslate2), no network round trip per segment
+class local_whisper_backend(stt_backend):
+    _models = dict() # (model_size, device, compute_type, cpu_threads, num_workers) -> (model, pipeline), loaded once per process
+    _models_lock = threading.Lock()
+
+    # model_size: whisper model name or path to a converted model
+    # num_workers: model replicas, lets that many threads transcribe in parallel
+    # batch_size: segments decoded together by transcribe_batch
+    # language: None means whisper detects it for every segment
+    def __init__(self, model_size:str="small", device:str="cpu", compute_type:str="int8", cpu_threads:int=4,
+                 num_workers:int=2, batch_size:int=8, beam_size:int=1, language:str=None):
+        if WhisperModel is None:
+            raise ImportError("local_whisper_backend needs faster-whisper (pip install faster-whisper)")
+        self._model_key = (model_size, device, compute_type, cpu_threads, num_workers)
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+        self.language = language
+
+    def _get_model(self):
+        models = local_whisper_backend._models
+        if self._model_key not in models:
+            with local_whisper_backend._models_lock:
+                if self._model_key not in models:
+                    model_size, device, compute_type, cpu_threads, num_workers = self._model_key
+                    model = WhisperModel(model_size, device=device, compute_type=compute_type,
+                                         cpu_threads=cpu_threads, num_workers=num_workers)
+                    models[self._model_key] = (model, BatchedInferencePipeline(model=model))
+        return models[self._model_key]
+
+    def warmup(self):
+        # loads the model and runs one decode, so the first real segment doesn't pay for it
+        self.transcribe(np.zeros(SAMPLE_RATE, dtype=np.int16).tobytes())
+
+    @staticmethod
+    def _to_float(audio):
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            return np.frombuffer(audio, dtype=np.int16).astype(np.float32) / 32768.0
+        return audio # file object, decoded by faster-whisper
+
+    def transcribe(self, audio, prompt:str=None) -> TranscriptResult:
+        model, _ = self._get_model()
+        segments, info = model.transcribe(
+            self._to_float(audio),
+            language=self.language,
+            beam_size=self.beam_size,
+            initial_prompt=prompt,
+            condition_on_previous_text=False,
+            vad_filter=False # segments are already cut by our VAD
+        )
+        segments = [TranscriptSegment(segment.start, segment.end, segment.text) for segment in segments]
+        text = "".join(segment.text for segment in segments).strip()
+        return TranscriptResult(text, _to_language(info.language), segments, info.duration)
+
+    # the batched pipeline detects the language per clip but doesn't report it,
+    # so results only carry a language when one was configured
+    def transcribe_batch(self, audios:Sequence, prompt:str=None) -> List[TranscriptResult]:
+        # all segments are concatenated and decoded as clips of one batched pass
+        # segments longer than MAX_CLIP_SECONDS are split into several clips
+        _, pipeline = self._get_model()
+        clip_starts = [] # seconds, sorted
+        clip_owners = [] # index into audios
+        owner_starts = [] # seconds, where each audio starts in the concatenation
+        durations = []
+        chunks = []
+        offset = 0
+        max_clip = MAX_CLIP_SECONDS * SAMPLE_RATE
+        for index, audio in enumerate(audios):
+            samples = self._to_float(audio)
+            owner_starts.append(offset / SAMPLE_RATE)
+            durations.append(len(samples) / SAMPLE_RATE)
+            for start in range(0, len(samples), max_clip):
+                clip = samples[start:start + max_clip]
+                clip_starts.append(offset / SAMPLE_RATE)
+                clip_owners.append(index)
+                chunks.append(clip)
+                offset += len(clip)
+        language = _to_language(self.language)
+        results = [[] for _ in audios]
+        if not chunks:
+            return [TranscriptResult("", language, [], duration) for duration in durations]
+        clip_ends = clip_starts[1:] + [offset / SAMPLE_RATE]
+        segments, _ = pipeline.transcribe(
+            np.concatenate(chunks),
+            language=self.language,
+            multilingual=self.language is None,
+            beam_size=self.beam_size,
+            initial_prompt=prompt,
+            batch_size=self.batch_size,
+            vad_filter=False,
+            clip_timestamps=[{"start": start, "end": end} for start, end in zip(clip_starts, clip_ends)]
+        )
+        for segment in segments:
+            # every result lies inside one clip, find it by its midpoint
+            clip = bisect.bisect_right(clip_starts, (segment.start + segment.end) / 2) - 1
+            owner = clip_owners[max(clip, 0)]
+            results[owner].append(TranscriptSegment(segment.start - owner_starts[owner], segment.end - owner_starts[owner], segment.text))
+        return [TranscriptResult("".join(segment.text for segment in parts).strip(), language, parts, duration)
+                for parts, duration in zip(results, durations)]
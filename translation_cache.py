@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+CacheKey = Tuple[str, str, str, str]
+
+# caches translations in front of text_translator
+# tier 1: in-memory LRU, tier 2 (optional): SQLite file that survives restarts
+# failures are only kept in memory, for failure_ttl seconds
+class translation_cache(object):
+
+    def __init__(self, max_size:int=4096, db_path:str=None, failure_ttl:float=30.0):
+        self._max_size = max_size
+        self._failure_ttl = failure_ttl
+        self._entries: "OrderedDict[CacheKey, str]" = OrderedDict()
+        self._failures: Dict[CacheKey, float] = dict() # key -> expire time
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._failure_hits = 0
+        self._misses = 0
+        self._db = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS translations ("
+                "text TEXT, source TEXT, target TEXT, glossary TEXT, result TEXT, "
+                "PRIMARY KEY (text, source, target, glossary))"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(text:str, source_language:str, target_language:str, glossary_id:Optional[str]) -> CacheKey:
+        # same text with different spacing / unicode composition shares one entry
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        return (normalized, source_language, target_language, glossary_id or "")
+
+    def get(self, key:CacheKey) -> Tuple[bool, Optional[str]]:
+        """returns (True, translation) on hit, (True, None) if translating this key failed recently,
+            (False, None) on miss
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return True, self._entries[key]
+            expire_time = self._failures.get(key)
+            if expire_time is not None:
+                if expire_time > time.time():
+                    self._failure_hits += 1
+                    return True, None
+                del self._failures[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT result FROM translations WHERE text=? AND source=? AND target=? AND glossary=?", key
+                ).fetchone()
+                if row is not None:
+                    self._disk_hits += 1
+                    self._put_memory(key, row[0])
+                    return True, row[0]
+            self._misses += 1
+            return False, None
+
+    def put(self, key:CacheKey, value:str):
+        with self._lock:
+            self._failures.pop(key, None)
+            self._put_memory(key, value)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)", key + (value,))
+                self._db.commit()
+
+    def put_failure(self, key:CacheKey):
+        with self._lock:
+            self._failures[key] = time.time() + self._failure_ttl
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "failure_hits": self._failure_hits,
+                "misses": self._misses,
+                "size": len(self._entries),
+            }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _put_memory(self, key:CacheKey, value:str):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,37 @@
+import re
+import threading
+from typing import Iterable
+from opencc import OpenCC
+
+# offline Simplified Chinese -> Traditional Chinese (Taiwan phrasing) conversion
+# replaces the second (google) request after DeepL, which only outputs Simplified Chinese
+class zh_converter(object):
+    _opencc = None # conversion tables are loaded once per process
+    _opencc_lock = threading.Lock()
+
+    # protected_words: glossary keywords, kept exactly as they are
+    def __init__(self, protected_words:Iterable[str]=()):
+        protected = sorted({word for word in protected_words if word}, key=len, reverse=True)
+        self._protected_pattern = re.compile("|".join(map(re.escape, protected))) if protected else None
+
+    @classmethod
+    def _get_opencc(cls) -> OpenCC:
+        if cls._opencc is None:
+            with cls._opencc_lock:
+                if cls._opencc is None:
+                    cls._opencc = OpenCC("s2twp")
+        return cls._opencc
+
+    def convert(self, text:str) -> str:
+        opencc = self._get_opencc()
+        if self._protected_pattern is None:
+            return opencc.convert(text)
+        # convert only the text between keywords
+        pieces = []
+        last_end = 0
+        for match in self._protected_pattern.finditer(text):
+            pieces.append(opencc.convert(text[last_end:match.start()]))
+            pieces.append(match.group())
+            last_end = match.end()
+        pieces.append(opencc.convert(text[last_end:]))
+        return "".join(pieces)